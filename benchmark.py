@@ -0,0 +1,1578 @@
+"""Offline benchmarks of the bot.
+
+e2e runs bot.py unmodified against a local stand-in for the Telegram Bot API
+and a local HTTP server of generated test clips, drives it with simulated
+users and reports throughput, latency, CPU time and peak memory and disk use.
+
+    python benchmark.py e2e --users 8 --requests 40
+    python benchmark.py e2e --set SCHEDULER_POLICY=fifo --json fifo.json
+    python benchmark.py e2e --baseline fifo.json  # Fails if this run is slower
+
+Bot settings are passed with --set NAME=VALUE (see the Configuration section
+of bot.py), which sets the IIMEOW_<NAME> environment variable of the bot.
+
+The other modes import bot.py and time a single part of it:
+
+    python benchmark.py split  # Keyframe cuts against the old re-encoding
+    python benchmark.py scheduler  # Waits under each SCHEDULER_POLICY
+    python benchmark.py pool  # Reused YoutubeDL instances against new ones
+    python benchmark.py download  # Throughput of the download settings
+
+handlers runs bot.py too, floods it with commands through its webhook or
+polling and reports how long the handlers take to reply:
+
+    python benchmark.py handlers --updates 5000 --via webhook
+"""
+
+import argparse
+import heapq
+import http.server
+import json
+import math
+import mimetypes
+import os
+import random
+import re
+import resource
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import deque
+from urllib.parse import parse_qs, urlparse
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+CLIP_DIR = os.path.join(tempfile.gettempdir(), "iimeow-benchmark-clips")
+BOT_TOKEN = "123456:benchmark"
+
+# Test clips, generated once with ffmpeg and kept in CLIP_DIR
+CLIPS = {
+    "small": {"duration": 10, "size": "640x360", "bitrate": "800k"},
+    "medium": {"duration": 30, "size": "1280x720", "bitrate": "2500k"},
+    "large": {"duration": 60, "size": "1280x720", "bitrate": "4000k"},
+    "hls": {"duration": 30, "size": "1280x720", "bitrate": "2500k", "hls": True},
+    # One keyframe in the whole clip, so no keyframe cut fits a part
+    "longgop": {"duration": 40, "size": "1280x720", "bitrate": "4000k", "gop": 1200},
+}
+
+# Bot settings of every run, --set overrides them. The smaller Telegram
+# limit makes the medium and large clips go through splitting
+BOT_SETTINGS = {
+    "API_TOKEN": BOT_TOKEN,
+    "MAX_TELEGRAM_SIZE": 8 * 1024 * 1024,
+    "METRICS_PORT": None,
+}
+
+# Bot replies that end a request
+FINAL_STATUS = ("✅", "❌", "An unexpected error occurred")
+
+# Commands of the handler flood and the start of their replies
+FLOOD_COMMANDS = {
+    "/start": "Hi there!",
+    "/queue": "You are not currently in the queue.",
+}
+
+# Requests of the scheduler trace: (is_audio, shortest and longest duration)
+TRACE_JOBS = {
+    "audio": (True, 3 * 60, 6 * 60),
+    "clip": (False, 2 * 60, 10 * 60),
+    "lecture": (False, 60 * 60, 3 * 60 * 60),
+}
+
+# Results compared against a --baseline, and whether higher is better
+GATED_RESULTS = {
+    "jobs_per_minute": True,
+    "latency_p50": False,
+    "latency_p99": False,
+    "cpu_seconds": False,
+}
+
+
+def make_clip(name, spec):
+    """Generate a test clip unless it already exists, returns its URL path"""
+    duration = spec["duration"]
+    path = os.path.join(CLIP_DIR, f"{name}.m3u8" if spec.get("hls") else f"{name}.mp4")
+    if os.path.exists(path):
+        return os.path.basename(path)
+
+    os.makedirs(CLIP_DIR, exist_ok=True)
+    cmd = [
+        "ffmpeg",
+        "-v",
+        "error",
+        "-f",
+        "lavfi",
+        "-i",
+        f"testsrc2=size={spec['size']}:rate=30:duration={duration}",
+        "-f",
+        "lavfi",
+        "-i",
+        f"sine=frequency=440:duration={duration}",
+        # Noise keeps x264 from compressing the pattern far below the bitrate
+        "-vf",
+        "noise=alls=30:allf=t",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "ultrafast",
+        "-b:v",
+        spec["bitrate"],
+        "-maxrate",
+        spec["bitrate"],
+        "-bufsize",
+        spec["bitrate"],
+        "-g",
+        str(spec.get("gop", 60)),
+        "-c:a",
+        "aac",
+        "-b:a",
+        "128k",
+    ]
+    if spec.get("hls"):
+        cmd += ["-f", "hls", "-hls_time", "2", "-hls_playlist_type", "vod"]
+        cmd += ["-hls_segment_filename", os.path.join(CLIP_DIR, f"{name}%03d.ts")]
+    else:
+        cmd += ["-movflags", "+faststart"]
+    # Written under a temporary name so an interrupted run isn't reused
+    base, extension = os.path.splitext(path)
+    temporary = f"{base}-tmp{extension}"
+    print(f"Generating test clip {name}...")
+    subprocess.run(cmd + ["-y", temporary], check=True)
+    os.replace(temporary, path)
+    return os.path.basename(path)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers, None when it is empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return round(values[rank], 3)
+
+
+class MediaHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the test clips with range requests, optionally rate limited"""
+
+    protocol_version = "HTTP/1.1"  # Keeps connections open, as CDNs do
+    rate = None  # Bytes per second per connection
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        name = os.path.basename(urlparse(self.path).path)
+        path = os.path.join(CLIP_DIR, name)
+        if not name or not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+        if match and start > end:
+            self.send_error(416)
+            return
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", mimetypes.guess_type(name)[0] or "video/mp2t")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(path, "rb") as file:
+            file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = file.read(min(64 * 1024, remaining))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except OSError:
+                    return
+                remaining -= len(chunk)
+                if self.rate:
+                    time.sleep(len(chunk) / self.rate)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def user_message(update_id, message_id, user_id, text):
+    """A Bot API update with a private message from a user"""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+        },
+    }
+
+
+class FakeTelegram:
+    """Stand-in for the Bot API: queues updates for the bot and records replies.
+
+    Every outbound call is logged per chat as (time, method, message_id,
+    text), and waiting users are woken up whenever a chat gets a new call.
+    latency delays every call, upload_rate limits the bytes per second of
+    file uploads like a slow link to Telegram would. Like Telegram, calls
+    beyond chat_rate per second in one chat are answered with a 429 and a
+    retry_after, and rate_limit forces the next calls to be. fail answers
+    the next calls with a server error, slow_down delays a chat's calls.
+    """
+
+    def __init__(self, latency=0, upload_rate=None, chat_rate=None):
+        self.latency = latency
+        self.upload_rate = upload_rate
+        self.chat_rate = chat_rate
+        self.chat_calls = {}  # chat_id -> times of its calls in the last second
+        self.forced = []  # [chat_id or None, calls left, retry_after]
+        self.failing = []  # [chat_id or None, calls left, error_code]
+        self.failed = 0
+        self.slow_chats = {}  # chat_id -> seconds added to its calls
+        self.rejected = 0
+        self.changed = threading.Condition()
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.next_file_id = 1
+        self.chats = {}  # chat_id -> list of calls
+        self.polled = False
+        self.calls = 0
+        self.uploads = 0
+        self.upload_bytes = 0
+
+    def send_update(self, user_id, text):
+        """Queue a private message from a user, returns its message_id"""
+        with self.changed:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.updates.append(
+                user_message(self.next_update_id, message_id, user_id, text)
+            )
+            self.next_update_id += 1
+            self.changed.notify_all()
+        return message_id
+
+    def get_updates(self, params):
+        """Long poll for updates from the requested offset on"""
+        offset = int(params.get("offset", 0))
+        deadline = time.monotonic() + min(float(params.get("timeout", 0)), 5)
+        with self.changed:
+            self.polled = True
+            self.changed.notify_all()
+            while True:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                remaining = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    return list(self.updates)
+                self.changed.wait(remaining)
+
+    def rate_limit(self, calls, retry_after=1, chat_id=None):
+        """Answer the next calls, of one chat or any, with 429"""
+        with self.changed:
+            self.forced.append([chat_id, calls, retry_after])
+
+    def fail(self, calls, error_code=500, chat_id=None):
+        """Answer the next calls, of one chat or any, with a server error"""
+        with self.changed:
+            self.failing.append([chat_id, calls, error_code])
+
+    def slow_down(self, chat_id, seconds):
+        """Add seconds to every call of a chat"""
+        with self.changed:
+            self.slow_chats[chat_id] = seconds
+
+    def check_failure(self, method, params):
+        """Return the error code to fail a call with, or None to answer it"""
+        if method in ("getUpdates", "getMe"):
+            return None
+        chat_id = int(params.get("chat_id", 0))
+        with self.changed:
+            for failing in self.failing:
+                if failing[0] in (None, chat_id) and failing[1] > 0:
+                    failing[1] -= 1
+                    self.failed += 1
+                    self.changed.notify_all()
+                    return failing[2]
+        return None
+
+    def check_rate_limit(self, method, params):
+        """Return the retry_after to reject a call with, or None to accept it"""
+        if method in ("getUpdates", "getMe"):
+            return None
+        chat_id = int(params.get("chat_id", 0))
+        with self.changed:
+            for forced in self.forced:
+                if forced[0] in (None, chat_id) and forced[1] > 0:
+                    forced[1] -= 1
+                    self.rejected += 1
+                    self.changed.notify_all()
+                    return forced[2]
+            if not self.chat_rate:
+                return None
+            now = time.monotonic()
+            calls = self.chat_calls.setdefault(chat_id, [])
+            calls[:] = [when for when in calls if now - when < 1]
+            if len(calls) >= self.chat_rate:
+                self.rejected += 1
+                self.changed.notify_all()
+                return math.ceil(1 - (now - calls[0]))
+            calls.append(now)
+        return None
+
+    def call(self, method, params, upload_size):
+        """Answer one Bot API call and log it for its chat"""
+        if method == "getUpdates":
+            return self.get_updates(params)
+        if method == "getMe":
+            return {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Bench",
+                "username": "bench_bot",
+            }
+
+        if self.latency:
+            time.sleep(self.latency)
+        time.sleep(self.slow_chats.get(int(params.get("chat_id", 0)), 0))
+        if upload_size and self.upload_rate:
+            time.sleep(upload_size / self.upload_rate)
+
+        chat_id = int(params.get("chat_id", 0))
+        now = time.monotonic()
+        with self.changed:
+            self.calls += 1
+            if upload_size:
+                self.uploads += 1
+                self.upload_bytes += upload_size
+            if method == "editMessageText":
+                message_id = int(params["message_id"])
+            else:
+                message_id = self.next_message_id
+                self.next_message_id += 1
+            text = params.get("text") or params.get("caption")
+            self.chats.setdefault(chat_id, []).append((now, method, message_id, text))
+            self.changed.notify_all()
+            file_id = params.get("video") or params.get("audio")
+            if file_id is None and method in ("sendVideo", "sendAudio"):
+                file_id = f"file{self.next_file_id}"
+                self.next_file_id += 1
+
+        if method not in ("sendMessage", "editMessageText", "sendVideo", "sendAudio"):
+            return True
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        if text is not None:
+            message["caption" if method.startswith("sendV") else "text"] = text
+        if method == "sendVideo":
+            message["video"] = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "width": int(params.get("width", 0)),
+                "height": int(params.get("height", 0)),
+                "duration": int(params.get("duration", 0)),
+            }
+        elif method == "sendAudio":
+            message["audio"] = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "duration": int(params.get("duration", 0)),
+            }
+        return message
+
+    def wait_for_request(self, chat_id, since, timeout):
+        """Wait until a request sent at since has ended in a chat.
+
+        Returns (reply time, end time, final text); the end time is None if
+        the request timed out.
+        """
+        deadline = time.monotonic() + timeout
+        status_id = replied = None
+        seen = 0
+        with self.changed:
+            while True:
+                calls = self.chats.get(chat_id, [])
+                for when, method, message_id, text in calls[seen:]:
+                    if when < since:
+                        continue
+                    if replied is None:
+                        replied = when
+                        status_id = message_id
+                    if message_id == status_id or method == "sendMessage":
+                        if text and text.startswith(FINAL_STATUS):
+                            return replied, when, text
+                seen = len(calls)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return replied, None, None
+                self.changed.wait(remaining)
+
+
+class BotApiHandler(http.server.BaseHTTPRequestHandler):
+    """Routes /bot<token>/<method> calls to the FakeTelegram of the server"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.handle_call()
+
+    def handle_call(self):
+        url = urlparse(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        # Files come as a multipart body, only their size matters here
+        length = int(self.headers.get("Content-Length", 0))
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(1024 * 1024, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+        telegram = self.server.telegram
+        error_code = telegram.check_failure(method, params)
+        retry_after = None if error_code else telegram.check_rate_limit(method, params)
+        if error_code:
+            status = error_code
+            response = {
+                "ok": False,
+                "error_code": error_code,
+                "description": "Internal Server Error",
+            }
+        elif retry_after:
+            status = 429
+            response = {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            }
+        else:
+            status = 200
+            result = telegram.call(method, params, length)
+            response = {"ok": True, "result": result}
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalServer(http.server.ThreadingHTTPServer):
+    """HTTP server that ignores clients going away, as the bot does when stopped"""
+
+    daemon_threads = True
+    connections = 0  # Accepted so far, counted on the serving thread
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(handler, **attributes):
+    """Serve a handler on a free local port, returns the server"""
+    server = LocalServer(("127.0.0.1", 0), handler)
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class DiskSampler:
+    """Tracks the peak number of bytes under a directory in the background"""
+
+    def __init__(self, path, interval=0.2):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def measure(self):
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass  # Removed while walking
+        return total
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.measure())
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+
+def plan_workload(args, urls):
+    """Assign every request a user, a command and a URL.
+
+    A share of the requests repeats a URL another user asked for earlier,
+    the others get a URL of their own so they can't share work.
+    """
+    rng = random.Random(args.seed)
+    kinds = []
+    for item in args.mix.split(","):
+        kind, _, weight = item.partition("=")
+        kinds += [kind] * int(weight or 1)
+
+    requests = []
+    for i in range(args.requests):
+        user_id = 1000 + i % args.users
+        previous = [r for r in requests[-args.users :] if r[0] != user_id]
+        if previous and rng.random() < args.repeat:
+            _, command, url = rng.choice(previous)
+        else:
+            command = "/audio" if rng.random() < args.audio else "/video"
+            url = f"{urls[rng.choice(kinds)]}?request={i}"
+        requests.append((user_id, command, url))
+    return requests
+
+
+def run_user(telegram, user_id, requests, args, results):
+    """Send one user's requests in turn, thinking a while between them"""
+    rng = random.Random(args.seed + user_id)
+    for command, url in requests:
+        time.sleep(rng.expovariate(1 / args.think) if args.think else 0)
+        sent = time.monotonic()
+        telegram.send_update(user_id, f"{command} {url}")
+        replied, ended, text = telegram.wait_for_request(user_id, sent, args.timeout)
+        results.append(
+            {
+                "user": user_id,
+                "command": command,
+                "url": url,
+                "sent": sent,
+                "reply": replied - sent if replied else None,
+                "latency": ended - sent if ended else None,
+                "ok": bool(text and text.startswith("✅")),
+                "text": text,
+            }
+        )
+
+
+def bot_environment(settings):
+    """Environment passing settings to bot.py as IIMEOW_<NAME> overrides"""
+    env = dict(os.environ)
+    for name, value in settings.items():
+        env[f"IIMEOW_{name}"] = value if isinstance(value, str) else json.dumps(value)
+    return env
+
+
+def load_bot(settings=None):
+    """Import bot.py into this process, with its stores in a temporary directory.
+
+    Nothing is started, the micro-benchmarks only call its functions.
+    """
+    workdir = tempfile.mkdtemp(prefix="iimeow-benchmark-")
+    paths = {
+        "JOB_STORE_PATH": "jobs.db",
+        "FILE_ID_CACHE_PATH": "file_ids.db",
+        "JOB_TRACE_PATH": "job_trace.jsonl",
+        "SCRATCH_DIR": "downloads",
+    }
+    settings = {
+        **BOT_SETTINGS,
+        **{name: os.path.join(workdir, path) for name, path in paths.items()},
+        **(settings or {}),
+    }
+    os.environ.update(bot_environment(settings))
+    sys.path.insert(0, os.path.dirname(BOT_SCRIPT))
+    import bot
+
+    return bot
+
+
+def start_bot(workdir, settings, worker=False):
+    """Start a bot process in workdir with settings as environment overrides"""
+    env = bot_environment(settings)
+    log = open(os.path.join(workdir, "worker.log" if worker else "bot.log"), "ab")
+    cmd = [sys.executable, "-u", BOT_SCRIPT] + (["--worker"] if worker else [])
+    return subprocess.Popen(
+        cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+def stop_bot(process):
+    """Stop a bot process, returns its resource usage and its children's"""
+    process.send_signal(signal.SIGTERM)
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return None
+    process.returncode = status
+    return usage
+
+
+def read_timings(workdir):
+    """Average seconds per step of the jobs in the bot's trace log"""
+    totals, counts = {}, {}
+    path = os.path.join(workdir, "job_trace.jsonl")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        for line in file:
+            record = json.loads(line)
+            if record.get("event") != "finished":
+                continue
+            for step, seconds in record.get("timings", {}).items():
+                totals[step] = totals.get(step, 0) + seconds
+                counts[step] = counts.get(step, 0) + 1
+    return {step: round(totals[step] / counts[step], 3) for step in sorted(totals)}
+
+
+def run_e2e(args):
+    """Run the end-to-end benchmark and return its results"""
+    urls = {}
+    media = start_server(MediaHandler)
+    MediaHandler.rate = args.media_rate
+    for item in args.mix.split(","):
+        name = item.partition("=")[0]
+        if name not in CLIPS:
+            raise SystemExit(f"Unknown clip {name!r}, choose from {', '.join(CLIPS)}")
+        path = make_clip(name, CLIPS[name])
+        urls[name] = f"http://127.0.0.1:{media.server_port}/{path}"
+
+    telegram = FakeTelegram(args.api_latency, args.upload_rate, args.chat_rate)
+    api = start_server(BotApiHandler, telegram=telegram)
+
+    settings = dict(BOT_SETTINGS)
+    settings["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api.server_port}"
+    for item in args.set:
+        name, _, value = item.partition("=")
+        settings[name] = value
+
+    workdir = tempfile.mkdtemp(prefix="iimeow-benchmark-")
+    processes = [start_bot(workdir, settings)]
+    processes += [
+        start_bot(workdir, settings, worker=True) for _ in range(args.workers)
+    ]
+    with telegram.changed:
+        if not telegram.changed.wait_for(lambda: telegram.polled, timeout=30):
+            raise SystemExit(f"The bot didn't start, see {workdir}/bot.log")
+
+    users = {}
+    for user_id, command, url in plan_workload(args, urls):
+        users.setdefault(user_id, []).append((command, url))
+
+    disk = DiskSampler(workdir)
+    results = []
+    started = time.monotonic()
+    threads = [
+        threading.Thread(
+            target=run_user,
+            args=(telegram, user_id, requests, args, results),
+        )
+        for user_id, requests in users.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    usages = [stop_bot(process) for process in processes]
+    peak_disk = disk.stop()
+    usages = [usage for usage in usages if usage]
+
+    if args.keep:
+        print(f"Bot logs and stores kept in {workdir}")
+    timings = read_timings(workdir)
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    media.shutdown()
+    api.shutdown()
+
+    done = [result for result in results if result["ok"]]
+    latencies = [result["latency"] for result in done]
+    replies = [result["reply"] for result in results if result["reply"] is not None]
+    return {
+        "requests": len(results),
+        "completed": len(done),
+        "failed": sum(1 for r in results if not r["ok"] and r["latency"] is not None),
+        "timed_out": sum(1 for result in results if result["latency"] is None),
+        "seconds": round(elapsed, 2),
+        "jobs_per_minute": round(len(done) / elapsed * 60, 2),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "reply_p50": percentile(replies, 0.5),
+        "reply_p99": percentile(replies, 0.99),
+        "cpu_seconds": round(sum(u.ru_utime + u.ru_stime for u in usages), 2),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": max((u.ru_maxrss * 1024 for u in usages), default=None),
+        "peak_disk_bytes": peak_disk,
+        "media_connections": media.connections,
+        "api_calls": telegram.calls,
+        "rate_limited": telegram.rejected,
+        "uploads": telegram.uploads,
+        "upload_bytes": telegram.upload_bytes,
+        "step_seconds": timings,
+        "errors": sorted({r["text"] for r in results if not r["ok"] and r["text"]}),
+        "settings": {
+            name: value for name, value in settings.items() if name != "API_TOKEN"
+        },
+    }
+
+
+def print_e2e(report):
+    def seconds(value):
+        return "-" if value is None else f"{value:.2f} s"
+
+    mib = 1024 * 1024
+    print(
+        f"requests     {report['requests']} ({report['completed']} completed, "
+        f"{report['failed']} failed, {report['timed_out']} timed out) "
+        f"in {report['seconds']:.1f} s"
+    )
+    print(f"throughput   {report['jobs_per_minute']:.1f} jobs/min")
+    print(
+        f"latency      p50 {seconds(report['latency_p50'])}, "
+        f"p99 {seconds(report['latency_p99'])}"
+    )
+    print(
+        f"first reply  p50 {seconds(report['reply_p50'])}, "
+        f"p99 {seconds(report['reply_p99'])}"
+    )
+    print(f"cpu          {report['cpu_seconds']:.1f} s, bot and ffmpeg")
+    if report["peak_rss_bytes"]:
+        print(f"peak rss     {report['peak_rss_bytes'] / mib:.0f} MiB")
+    print(f"peak disk    {report['peak_disk_bytes'] / mib:.0f} MiB")
+    print(f"media        {report['media_connections']} connections")
+    print(
+        f"telegram     {report['api_calls']} calls, {report['uploads']} uploads "
+        f"of {report['upload_bytes'] / mib:.0f} MiB, "
+        f"{report['rate_limited']} answered with 429"
+    )
+    if report["step_seconds"]:
+        steps = ", ".join(f"{k} {v:.2f}" for k, v in report["step_seconds"].items())
+        print(f"mean steps   {steps}")
+    for error in report["errors"]:
+        print(f"error        {error}")
+
+
+def free_port():
+    """A local port nothing listens on right now"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    """Wait until a bot process accepts connections on a local port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def flood_chat(telegram, webhook, updates, sent, interval=0):
+    """Send chats' commands one after another, noting when each went out.
+
+    With an interval, the updates go out on that schedule as long as the
+    bot keeps up, like they would from users who don't wait for replies.
+    """
+    started = time.monotonic()
+    for i, (update_id, chat_id, command) in enumerate(updates):
+        time.sleep(max(0, started + i * interval - time.monotonic()))
+        sent[chat_id].append(time.monotonic())
+        if webhook is None:
+            telegram.send_update(chat_id, command)
+            continue
+        request = urllib.request.Request(
+            webhook,
+            json.dumps(user_message(update_id, update_id, chat_id, command)).encode(),
+            {
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": "benchmark",
+            },
+        )
+        urllib.request.urlopen(request).close()
+
+
+def run_handlers(args):
+    """Flood a bot with commands and time its replies to them.
+
+    Each chat sends from one thread, so its replies must come back in the
+    order of its commands. A reply is matched to a command by that order.
+    """
+    telegram = FakeTelegram(args.api_latency)
+    api = start_server(BotApiHandler, telegram=telegram)
+
+    settings = dict(BOT_SETTINGS)
+    settings["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api.server_port}"
+    # Lifted so the handlers are measured, not the bot's Bot API rate limits
+    for name in ("TELEGRAM_GLOBAL_RATE", "TELEGRAM_CHAT_RATE", "TELEGRAM_CHAT_BURST"):
+        settings[name] = 10**6
+    webhook = None
+    if args.via == "webhook":
+        port = free_port()
+        webhook = f"http://127.0.0.1:{port}/webhook"
+        settings.update(WEBHOOK_URL=webhook, WEBHOOK_PORT=port)
+        settings["WEBHOOK_SECRET"] = "benchmark"
+    for item in args.set:
+        name, _, value = item.partition("=")
+        settings[name] = value
+
+    workdir = tempfile.mkdtemp(prefix="iimeow-benchmark-")
+    process = start_bot(workdir, settings)
+    if webhook:
+        started = wait_for_port(port, process)
+    else:
+        with telegram.changed:
+            started = telegram.changed.wait_for(lambda: telegram.polled, timeout=30)
+    if not started:
+        raise SystemExit(f"The bot didn't start, see {workdir}/bot.log")
+
+    rng = random.Random(args.seed)
+    chats = [1000 + i for i in range(args.chats)]
+    updates = [
+        (update_id, rng.choice(chats), rng.choice(list(FLOOD_COMMANDS)))
+        for update_id in range(1, args.updates + 1)
+    ]
+    sent = {chat_id: [] for chat_id in chats}
+    threads = [
+        threading.Thread(
+            target=flood_chat,
+            args=(
+                telegram,
+                webhook,
+                [u for u in updates if u[1] % args.clients == client],
+                sent,
+                args.clients / args.rate if args.rate else 0,
+            ),
+        )
+        for client in range(args.clients)
+    ]
+
+    def replies(chat_id):
+        calls = telegram.chats.get(chat_id, [])
+        return [call for call in calls if call[1] == "sendMessage"]
+
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    with telegram.changed:
+        telegram.changed.wait_for(
+            lambda: sum(len(replies(chat_id)) for chat_id in chats) >= len(updates),
+            timeout=args.timeout,
+        )
+    usage = stop_bot(process)
+    api.shutdown()
+    if args.keep:
+        print(f"Bot logs and stores kept in {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = []
+    out_of_order = 0
+    for chat_id in chats:
+        commands = [command for _, chat, command in updates if chat == chat_id]
+        for when, command, reply in zip(sent[chat_id], commands, replies(chat_id)):
+            latencies.append(reply[0] - when)
+            if not (reply[3] or "").lstrip().startswith(FLOOD_COMMANDS[command]):
+                out_of_order += 1
+    return {
+        "via": args.via,
+        "updates": len(updates),
+        "chats": len(chats),
+        "seconds": round(elapsed, 2),
+        "updates_per_second": round(len(updates) / elapsed, 1),
+        "replied": len(latencies),
+        "out_of_order": out_of_order,
+        "handler_p50": percentile(latencies, 0.5),
+        "handler_p95": percentile(latencies, 0.95),
+        "handler_p99": percentile(latencies, 0.99),
+        "handler_max": round(max(latencies), 3) if latencies else None,
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 2) if usage else None,
+    }
+
+
+def print_handlers(report):
+    print(
+        f"updates      {report['updates']} to {report['chats']} chats "
+        f"by {report['via']} in {report['seconds']:.1f} s, "
+        f"{report['updates_per_second']:.0f}/s"
+    )
+    print(f"replies      {report['replied']}, {report['out_of_order']} out of order")
+    if report["replied"]:
+        print(
+            f"handler      p50 {report['handler_p50'] * 1000:.0f} ms, "
+            f"p95 {report['handler_p95'] * 1000:.0f} ms, "
+            f"p99 {report['handler_p99'] * 1000:.0f} ms, "
+            f"max {report['handler_max'] * 1000:.0f} ms"
+        )
+    if report["cpu_seconds"] is not None:
+        print(f"cpu          {report['cpu_seconds']:.1f} s, bot")
+
+
+def get_media_duration(filename):
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration"]
+    cmd += ["-of", "default=noprint_wrappers=1:nokey=1", filename]
+    return float(subprocess.check_output(cmd, text=True))
+
+
+def legacy_split_video(input_file, max_size):
+    """How bot.py split videos before keyframe cuts, kept as the baseline.
+
+    Equal parts, each re-encoded one after the other at 1500k, retried at
+    750k when too large. Parts were planned at 90% of the limit.
+    """
+    safe_max_size = max_size * 0.9
+    num_parts = math.ceil(os.path.getsize(input_file) / safe_max_size)
+    segment_duration = get_media_duration(input_file) / num_parts
+
+    output_files = []
+    for i in range(num_parts):
+        output_file = f"{input_file[:-4]}_part{i+1}.mp4"
+        cmd = ["ffmpeg", "-i", input_file, "-ss", str(i * segment_duration)]
+        cmd += ["-t", str(segment_duration), "-c:v", "libx264", "-b:v", "1500k"]
+        cmd += ["-c:a", "aac", "-b:a", "128k", "-max_muxing_queue_size", "1024"]
+        cmd += [output_file, "-y"]
+        subprocess.run(cmd, capture_output=True)
+        if os.path.getsize(output_file) > safe_max_size:
+            cmd[cmd.index("1500k")] = "750k"
+            subprocess.run(cmd, capture_output=True)
+        output_files.append(output_file)
+    return output_files
+
+
+def cpu_seconds():
+    """CPU time of this process and its finished children, e.g. ffmpeg"""
+    usages = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(
+        resource.RUSAGE_CHILDREN
+    )
+    return sum(usage.ru_utime + usage.ru_stime for usage in usages)
+
+
+def run_split(args):
+    """Time splitting each clip with keyframe cuts and with the old re-encoding"""
+    bot = load_bot({"MAX_TELEGRAM_SIZE": args.limit})
+    workdir = tempfile.mkdtemp(prefix="iimeow-benchmark-")
+    methods = {
+        "keyframe": lambda path: list(
+            bot.SplitParts([job for job, _ in bot.plan_video_split(path, args.limit)])
+        ),
+        "reencode": lambda path: legacy_split_video(path, args.limit),
+    }
+
+    results = []
+    for name in args.clips.split(","):
+        if name not in CLIPS or CLIPS[name].get("hls"):
+            raise SystemExit(f"Unknown clip {name!r}")
+        clip = os.path.join(CLIP_DIR, make_clip(name, CLIPS[name]))
+        for method, split in methods.items():
+            path = os.path.join(workdir, f"{name}.mp4")
+            shutil.copyfile(clip, path)
+            started, cpu = time.monotonic(), cpu_seconds()
+            parts = split(path)
+            elapsed, cpu = time.monotonic() - started, cpu_seconds() - cpu
+            sizes = [os.path.getsize(part) if part else None for part in parts]
+            results.append(
+                {
+                    "clip": name,
+                    "method": method,
+                    "size": os.path.getsize(clip),
+                    "parts": len(parts),
+                    "largest": max((size or 0 for size in sizes), default=0),
+                    "failed": sum(1 for size in sizes if size is None),
+                    "seconds": round(elapsed, 2),
+                    "cpu_seconds": round(cpu, 2),
+                }
+            )
+            for part in parts:
+                if part and os.path.exists(part):
+                    os.remove(part)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {"limit": args.limit, "results": results}
+
+
+def print_split(report):
+    mib = 1024 * 1024
+    print(f"limit {report['limit'] / mib:.1f} MiB")
+    print("clip     method    size      parts  largest   failed  wall     cpu")
+    for r in report["results"]:
+        print(
+            f"{r['clip']:<8} {r['method']:<9} {r['size'] / mib:5.1f} MiB "
+            f"{r['parts']:5}  {r['largest'] / mib:5.2f} MiB {r['failed']:6}  "
+            f"{r['seconds']:5.1f} s  {r['cpu_seconds']:5.1f} s"
+        )
+
+
+def run_pool(args):
+    """Time jobs on one shared YoutubeDLPool and on a new pool per job.
+
+    A job extracts a clip's info_dict and downloads it, like the extract
+    and download stages do. The media server counts the connections opened.
+    """
+    bot = load_bot()
+    media = start_server(MediaHandler)
+    if args.clip not in CLIPS or CLIPS[args.clip].get("hls"):
+        raise SystemExit(f"Unknown clip {args.clip!r}")
+    url = (
+        f"http://127.0.0.1:{media.server_port}/{make_clip(args.clip, CLIPS[args.clip])}"
+    )
+    workdir = tempfile.mkdtemp(prefix="iimeow-benchmark-")
+
+    results = []
+    shared = bot.YoutubeDLPool()
+    for method in ("new", "shared"):
+        connections = media.connections
+        setup = total = 0
+        for i in range(args.jobs):
+            pool = shared if method == "shared" else bot.YoutubeDLPool()
+            jobdir = os.path.join(workdir, f"{method}{i}")
+            started = time.monotonic()
+            pool.get("info")
+            pool.get("video")
+            setup += time.monotonic() - started
+            pool.get("video").params["noprogress"] = True  # Keeps the report readable
+            info = pool.extract_info(f"{url}?job={i}")
+            pool.download(info, "video", workdir=jobdir)
+            total += time.monotonic() - started
+            shutil.rmtree(jobdir, ignore_errors=True)
+            if pool is not shared:
+                pool.discard("info")
+                pool.discard("video")
+        results.append(
+            {
+                "method": method,
+                "jobs": args.jobs,
+                "setup_seconds": round(setup / args.jobs, 4),
+                "job_seconds": round(total / args.jobs, 4),
+                "connections": round((media.connections - connections) / args.jobs, 2),
+            }
+        )
+    media.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {"clip": args.clip, "results": results}
+
+
+def print_pool(report):
+    print(f"clip {report['clip']}, per job:")
+    print("pools    setup      total      connections")
+    for r in report["results"]:
+        print(
+            f"{r['method']:<8} {r['setup_seconds'] * 1000:6.1f} ms  "
+            f"{r['job_seconds'] * 1000:6.1f} ms  {r['connections']:11.2f}"
+        )
+
+
+def download_settings(args):
+    """Every combination of the swept settings, in MiB and MiB/s"""
+    limits = [
+        None if item == "none" else float(item) for item in args.limits.split(",")
+    ]
+    for fragments in map(int, args.fragments.split(",")):
+        for chunk in map(float, args.chunk_sizes.split(",")):
+            for limit in limits:
+                yield fragments, chunk, limit
+
+
+def run_download(args):
+    """Download clips with each combination of the download settings.
+
+    Every run starts --jobs downloads of a clip at once, through
+    download_youtube_content and the bandwidth allocator like the download
+    stage, from a media server throttling each connection to --media-rate.
+    Nothing is split or uploaded.
+    """
+    bot = load_bot()
+    media = start_server(MediaHandler)
+    MediaHandler.rate = args.media_rate
+    urls = {}
+    for name in args.clips.split(","):
+        if name not in CLIPS:
+            raise SystemExit(f"Unknown clip {name!r}, choose from {', '.join(CLIPS)}")
+        path = make_clip(name, CLIPS[name])
+        urls[name] = f"http://127.0.0.1:{media.server_port}/{path}"
+    workdir = tempfile.mkdtemp(prefix="iimeow-benchmark-")
+    mib = 1024 * 1024
+
+    results = []
+    for fragments, chunk, limit in download_settings(args):
+        # The pool reads these when it builds its instances
+        bot.DOWNLOAD_FRAGMENTS = fragments
+        bot.DOWNLOAD_CHUNK_SIZE = int(chunk * mib) or None
+        bot.ydl_pool = bot.YoutubeDLPool()
+        bot.bandwidth = bot.BandwidthAllocator(limit and limit * mib)
+        for name, url in urls.items():
+            jobs = {}  # job number -> bytes, seconds and whether it finished
+            shares = {i: [] for i in range(args.jobs)}
+
+            def download(i):
+                info = bot.ydl_pool.extract_info(f"{url}?job={i}")
+                bot.ydl_pool.get("video").params["noprogress"] = True
+                jobdir = os.path.join(workdir, f"job{i}")
+                received = [0, None]  # Bytes and when the last of them came
+
+                # Throughput is measured up to the last byte, without the
+                # post-processing after it
+                def throttle(amount):
+                    received[0] += amount
+                    received[1] = time.monotonic()
+                    bot.bandwidth.throttle(i, amount)
+
+                bot.bandwidth.add(i)
+                started = time.monotonic()
+                try:
+                    filename, _ = bot.download_youtube_content(
+                        url, info=info, workdir=jobdir, throttle=throttle
+                    )
+                finally:
+                    bot.bandwidth.remove(i)
+                    shutil.rmtree(jobdir, ignore_errors=True)
+                seconds = (received[1] or time.monotonic()) - started
+                jobs[i] = (received[0], seconds, filename is not None)
+
+            threads = [
+                threading.Thread(target=download, args=(i,)) for i in range(args.jobs)
+            ]
+            started = time.monotonic()
+            for thread in threads:
+                thread.start()
+            # Sample each download's share while they all run
+            while any(thread.is_alive() for thread in threads):
+                with bot.bandwidth.lock:
+                    if len(bot.bandwidth.buckets) == args.jobs:
+                        for i, bucket in bot.bandwidth.buckets.items():
+                            shares[i].append(bucket.rate)
+                time.sleep(0.1)
+            seconds = time.monotonic() - started
+
+            received = sum(size for size, _, _ in jobs.values())
+            results.append(
+                {
+                    "clip": name,
+                    "fragments": fragments,
+                    "chunk_mib": chunk,
+                    "limit_mib": limit,
+                    "failed": sum(1 for _, _, done in jobs.values() if not done),
+                    "seconds": round(seconds, 2),
+                    "mib_per_second": round(
+                        received / mib / max(s for _, s, _ in jobs.values()), 2
+                    ),
+                    "jobs_mib_per_second": [
+                        round(size / mib / job_seconds, 2)
+                        for size, job_seconds, _ in jobs.values()
+                    ],
+                    "jobs_share_mib": [
+                        round(statistics.mean(rates) / mib, 2) if rates else None
+                        for rates in shares.values()
+                    ],
+                }
+            )
+    media.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {"jobs": args.jobs, "media_rate": args.media_rate, "results": results}
+
+
+def print_download(report):
+    rate = report["media_rate"]
+    print(
+        f"{report['jobs']} downloads at once, "
+        + (f"{rate / 1024 / 1024:.1f} MiB/s per connection" if rate else "unthrottled")
+    )
+    print("clip     fragments chunk  limit   total        per job        shares")
+    for r in report["results"]:
+        chunk = f"{r['chunk_mib']:g}M" if r["chunk_mib"] else "none"
+        limit = f"{r['limit_mib']:g}M/s" if r["limit_mib"] else "none"
+        jobs = " ".join(f"{speed:.2f}" for speed in r["jobs_mib_per_second"])
+        shares = " ".join(
+            f"{share:.2f}" if share is not None else "-"
+            for share in r["jobs_share_mib"]
+        )
+        failed = f"  {r['failed']} failed" if r["failed"] else ""
+        print(
+            f"{r['clip']:<8} {r['fragments']:9} {chunk:>5}  {limit:>6}  "
+            f"{r['mib_per_second']:5.2f} MiB/s  {jobs:<13}  {shares}{failed}"
+        )
+
+
+def trace_info(duration):
+    """A trimmed info_dict offering 360p and 720p, as YouTube does"""
+    formats = [
+        {"format_id": "18", "ext": "mp4", "vcodec": "avc1", "acodec": "mp4a"},
+        {"format_id": "22", "ext": "mp4", "vcodec": "avc1", "acodec": "mp4a"},
+    ]
+    for fmt, height, tbr in zip(formats, (360, 720), (600, 1500)):
+        fmt.update(height=height, tbr=tbr)
+    return {"duration": duration, "tbr": 1500, "formats": formats}
+
+
+def plan_trace(args, bot):
+    """Synthetic arrivals: (time, user_id, kind, info_dict, service seconds).
+
+    Requests arrive as a Poisson process, a share of them from one heavy
+    user. A job really takes its estimated cost, off by a random factor.
+    """
+    rng = random.Random(args.seed)
+    kinds = []
+    for item in args.mix.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in TRACE_JOBS:
+            raise SystemExit(
+                f"Unknown job {kind!r}, choose from {', '.join(TRACE_JOBS)}"
+            )
+        kinds += [kind] * int(weight or 1)
+
+    trace = []
+    now = 0
+    for _ in range(args.requests):
+        now += rng.expovariate(args.rate / 60)
+        user_id = 0 if rng.random() < args.heavy else rng.randrange(1, args.users)
+        kind = rng.choice(kinds)
+        is_audio, shortest, longest = TRACE_JOBS[kind]
+        info = trace_info(rng.uniform(shortest, longest))
+        cost = bot.estimate_job_cost(info, is_audio)
+        service = cost * rng.lognormvariate(0, args.noise)
+        trace.append((now, user_id, kind, info, service))
+    return trace
+
+
+def replay_trace(bot, trace, slots):
+    """Run a trace through the bot's job ordering on a simulated clock.
+
+    Jobs wait ordered by arrival time plus get_job_cost, like in JobStore,
+    and run on `slots` parallel slots. Returns the requests turned away and
+    the (kind, seconds waited) of every job.
+    """
+    waiting = []  # (priority, arrival, kind, service seconds)
+    running = []  # Times the running jobs finish
+    recent = {}  # user_id -> deque of request times, like user_requests
+    rejected = 0
+    waits = []
+
+    def start_jobs(now):
+        while waiting and len(running) < slots:
+            _, arrival, kind, service = heapq.heappop(waiting)
+            waits.append((kind, now - arrival))
+            heapq.heappush(running, now + service)
+
+    for i, (arrival, user_id, kind, info, service) in enumerate(trace):
+        # Jobs finishing before this request free their slots first
+        while running and running[0] <= arrival:
+            start_jobs(heapq.heappop(running))
+
+        times = recent.setdefault(user_id, deque())
+        while times and arrival - times[0] > bot.USER_RATE_WINDOW:
+            times.popleft()
+        if len(times) >= bot.USER_RATE_LIMIT or len(waiting) >= bot.MAX_QUEUE_SIZE:
+            rejected += 1
+            continue
+        times.append(arrival)
+
+        # get_job_cost reads the cached metadata and the user's recent requests
+        url = f"https://www.youtube.com/watch?v=trace{i:06d}"
+        bot.metadata_cache[bot.extract_video_id(url)] = (time.monotonic(), info)
+        bot.user_requests[user_id] = times
+        cost = bot.get_job_cost(user_id, url, TRACE_JOBS[kind][0])
+        heapq.heappush(waiting, (arrival + cost, arrival, kind, service))
+        start_jobs(arrival)
+
+    while running:
+        start_jobs(heapq.heappop(running))
+    return rejected, waits
+
+
+def run_scheduler(args):
+    """Replay one synthetic trace under every scheduling policy"""
+    bot = load_bot()
+    trace = plan_trace(args, bot)
+    results = []
+    for policy in args.policies.split(","):
+        bot.SCHEDULER_POLICY = policy
+        bot.metadata_cache.clear()
+        rejected, waits = replay_trace(bot, trace, args.slots)
+        result = {"policy": policy, "completed": len(waits), "rejected": rejected}
+        for kind in ("all", *TRACE_JOBS):
+            seconds = [wait for k, wait in waits if kind in ("all", k)]
+            result[kind] = {
+                "wait_p50": percentile(seconds, 0.5),
+                "wait_p95": percentile(seconds, 0.95),
+                "wait_max": round(max(seconds), 3) if seconds else None,
+            }
+        results.append(result)
+    span = trace[-1][0] if trace else 0
+    load = sum(request[4] for request in trace) / (span * args.slots) if span else 0
+    return {"requests": len(trace), "load": round(load, 2), "results": results}
+
+
+def print_scheduler(report):
+    print(f"requests {report['requests']}, offered load {report['load']:.0%}")
+    print("policy  jobs     done  rejected  wait p50   wait p95   wait max")
+    for r in report["results"]:
+        for kind in ("all", *TRACE_JOBS):
+            waits = r[kind]
+            if waits["wait_p50"] is None:
+                continue
+            done, rejected = (
+                (r["completed"], r["rejected"]) if kind == "all" else ("", "")
+            )
+            print(
+                f"{r['policy']:<7} {kind:<8} {done:>4}  {rejected:>8}  "
+                f"{waits['wait_p50']:7.1f} s  {waits['wait_p95']:7.1f} s  "
+                f"{waits['wait_max']:7.1f} s"
+            )
+
+
+def check_baseline(report, baseline, tolerance):
+    """List the results that got worse than the baseline by more than tolerance"""
+    regressions = []
+    for name, higher_is_better in GATED_RESULTS.items():
+        old, new = baseline.get(name), report.get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{name}: {old} -> {new} ({change:+.0%})")
+    if report["completed"] < baseline.get("completed", 0):
+        regressions.append(
+            f"completed: {baseline['completed']} -> {report['completed']}"
+        )
+    return regressions
+
+
+# Every mode runs a benchmark returning its results and prints them
+MODES = {
+    "e2e": (run_e2e, print_e2e),
+    "split": (run_split, print_split),
+    "scheduler": (run_scheduler, print_scheduler),
+    "handlers": (run_handlers, print_handlers),
+    "pool": (run_pool, print_pool),
+    "download": (run_download, print_download),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    e2e = modes.add_parser("e2e", help="the whole bot under simulated users")
+    e2e.add_argument("--users", type=int, default=8, help="simulated users")
+    e2e.add_argument("--requests", type=int, default=40, help="requests in total")
+    e2e.add_argument(
+        "--mix",
+        default="small=4,medium=2,large=1",
+        help="clips to request and their weights, from " + ", ".join(CLIPS),
+    )
+    e2e.add_argument("--audio", type=float, default=0.25, help="share of /audio")
+    e2e.add_argument(
+        "--repeat", type=float, default=0.2, help="share repeating a recent URL"
+    )
+    e2e.add_argument(
+        "--think",
+        type=float,
+        default=1.0,
+        help="mean seconds between a user's requests",
+    )
+    e2e.add_argument("--seed", type=int, default=1)
+    e2e.add_argument(
+        "--timeout", type=float, default=600, help="seconds before a request is lost"
+    )
+    e2e.add_argument(
+        "--workers", type=int, default=0, help="extra bot.py --worker processes"
+    )
+    e2e.add_argument(
+        "--media-rate", type=float, help="bytes per second per media connection"
+    )
+    e2e.add_argument(
+        "--upload-rate", type=float, help="bytes per second of uploads to Telegram"
+    )
+    e2e.add_argument(
+        "--api-latency", type=float, default=0, help="seconds added to every API call"
+    )
+    e2e.add_argument(
+        "--chat-rate",
+        type=int,
+        help="calls per second a chat may make before getting 429s",
+    )
+    e2e.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="bot setting, numbers and null as JSON",
+    )
+    e2e.add_argument("--json", help="write the results to this file")
+    e2e.add_argument("--baseline", help="results to compare with, from --json")
+    e2e.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed change from the baseline"
+    )
+    e2e.add_argument(
+        "--keep", action="store_true", help="keep the bot's logs and stores"
+    )
+
+    split = modes.add_parser("split", help="splitting oversized videos")
+    split.add_argument("--clips", default="medium,large,longgop", help="clips to split")
+    split.add_argument(
+        "--limit",
+        type=int,
+        default=BOT_SETTINGS["MAX_TELEGRAM_SIZE"],
+        help="bytes each part must stay under",
+    )
+    split.add_argument("--json", help="write the results to this file")
+
+    scheduler = modes.add_parser(
+        "scheduler", help="job waits under each policy, from a simulated trace"
+    )
+    scheduler.add_argument("--requests", type=int, default=2000)
+    scheduler.add_argument("--users", type=int, default=50, help="simulated users")
+    scheduler.add_argument(
+        "--rate", type=float, default=2.5, help="mean requests per minute"
+    )
+    scheduler.add_argument(
+        "--mix",
+        default="audio=3,clip=4,lecture=1",
+        help="jobs to request and their weights, from " + ", ".join(TRACE_JOBS),
+    )
+    scheduler.add_argument(
+        "--heavy", type=float, default=0.1, help="share of requests from one user"
+    )
+    scheduler.add_argument(
+        "--noise",
+        type=float,
+        default=0.5,
+        help="spread of real job times around the estimate, as a lognormal sigma",
+    )
+    scheduler.add_argument(
+        "--slots", type=int, default=10, help="jobs running at once, MAX_ACTIVE_JOBS"
+    )
+    scheduler.add_argument("--policies", default="fifo,fair")
+    scheduler.add_argument("--seed", type=int, default=1)
+    scheduler.add_argument("--json", help="write the results to this file")
+
+    handlers = modes.add_parser(
+        "handlers", help="command handler latency under a flood of updates"
+    )
+    handlers.add_argument("--updates", type=int, default=5000)
+    handlers.add_argument("--chats", type=int, default=200)
+    handlers.add_argument(
+        "--clients", type=int, default=16, help="threads sending the updates"
+    )
+    handlers.add_argument(
+        "--rate", type=float, help="updates per second, as fast as possible if unset"
+    )
+    handlers.add_argument("--via", choices=("webhook", "polling"), default="webhook")
+    handlers.add_argument(
+        "--api-latency",
+        type=float,
+        default=0.05,
+        help="seconds added to every API call",
+    )
+    handlers.add_argument(
+        "--timeout", type=float, default=120, help="seconds to wait for the replies"
+    )
+    handlers.add_argument("--seed", type=int, default=1)
+    handlers.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="bot setting, numbers and null as JSON",
+    )
+    handlers.add_argument("--json", help="write the results to this file")
+    handlers.add_argument(
+        "--keep", action="store_true", help="keep the bot's logs and stores"
+    )
+
+    pool = modes.add_parser("pool", help="setup cost and connections of YoutubeDL")
+    pool.add_argument("--clip", default="small", help="clip every job downloads")
+    pool.add_argument("--jobs", type=int, default=20)
+    pool.add_argument("--json", help="write the results to this file")
+
+    download = modes.add_parser(
+        "download", help="download throughput of the download settings"
+    )
+    download.add_argument("--clips", default="hls,medium", help="clips to download")
+    download.add_argument(
+        "--jobs", type=int, default=2, help="downloads running at once"
+    )
+    download.add_argument(
+        "--media-rate",
+        type=float,
+        default=2 * 1024 * 1024,
+        help="bytes per second per media connection",
+    )
+    download.add_argument(
+        "--fragments", default="1,4", help="DOWNLOAD_FRAGMENTS values to try"
+    )
+    download.add_argument(
+        "--chunk-sizes",
+        default="0,1",
+        help="DOWNLOAD_CHUNK_SIZE values to try in MiB, 0 for none",
+    )
+    download.add_argument(
+        "--limits",
+        default="none,4",
+        help="BANDWIDTH_LIMIT values to try in MiB/s, none for no limit",
+    )
+    download.add_argument("--json", help="write the results to this file")
+
+    args = parser.parse_args()
+    run, show = MODES[args.mode]
+    report = run(args)
+    show(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if getattr(args, "baseline", None):
+        with open(args.baseline) as file:
+            regressions = check_baseline(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"regression   {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
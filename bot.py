@@ -1,11 +1,30 @@
 import os
+import glob
+import http.server
+import re
+import shutil
+import requests
 import telebot
 import yt_dlp
 import threading
+import queue
+import socket
+import sys
 from queue import Queue
 from urllib.parse import urlparse, parse_qs
 import math
+import random
 import subprocess
+import sqlite3
+import struct
+import json
+import copy
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from functools import partial
+from itertools import islice
+from telebot.apihelper import ApiTelegramException
 from datetime import datetime
 
 # Configuration
@@ -13,16 +32,1189 @@ API_TOKEN = "<YOUR_BOT_API_TOKEN>"
 MAX_TELEGRAM_SIZE = 50 * 1024 * 1024  # 50 MB in bytes
 MAX_FILE_SIZE = 1.9 * 1024 * 1024 * 1024  # 1.9 GB in bytes
 MAX_CONCURRENT_DOWNLOADS = 5  # Maximum concurrent downloads
+MAX_ACTIVE_JOBS = 10  # Jobs admitted to the pipeline before users have to wait
+EXTRACT_WORKERS = 4  # Concurrent metadata extractions
+UPLOAD_WORKERS = 5  # Concurrent uploads to Telegram
+STAGE_QUEUE_SIZE = 2  # Jobs held between stages before the previous one waits
 MAX_QUEUE_SIZE = 50  # Maximum number of users in queue
+METADATA_CACHE_TTL = 30 * 60  # Seconds before cached video metadata expires
+METADATA_CACHE_SIZE = 256  # Maximum number of cached info_dicts
+FILE_ID_CACHE_PATH = "file_ids.db"  # SQLite store of already uploaded files
+FILE_ID_CACHE_SIZE = 5000  # Maximum cached videos before evicting least used
+AUDIO_QUALITY = "192"  # MP3 bitrate in kbps for audio downloads
+VIDEO_FORMAT = "best[ext=mp4]/best"  # yt-dlp format selection for video
+MAX_PART_BUDGET = 10  # Most parts a user may ask a video to be split into
+TELEGRAM_GLOBAL_RATE = 30  # Bot API calls per second across all chats
+TELEGRAM_CHAT_RATE = 1  # Bot API calls per second in a single chat
+TELEGRAM_CHAT_BURST = 3  # Calls a chat may make at once after being idle
+TELEGRAM_MAX_RETRIES = 5  # Retries for failed or rate limited sends
+TELEGRAM_TRACKED_CHATS = 10000  # Messages whose shown status text is remembered
+TELEGRAM_EDIT_WORKERS = 4  # Status edits sent at once
+TELEGRAM_EDIT_TIMEOUT = 10  # Seconds a status edit may take before it is retried
+PROGRESS_UPDATE_INTERVAL = 3  # Seconds between live download progress updates
+SPLIT_WORKERS = os.cpu_count() or 2  # ffmpeg processes and split stage workers
+SPLIT_LOOKAHEAD = 3  # Parts produced ahead of the upload, caps disk usage
+SPLIT_HEADROOM = 512 * 1024  # Bytes every split part is planned to stay under the limit
+SCHEDULER_POLICY = "fair"  # "fair" runs cheap jobs first with aging, or "fifo"
+SCHEDULER_THROUGHPUT = 2 * 1024 * 1024  # Bytes per second a job is expected to move
+DEFAULT_JOB_COST = 60  # Expected seconds of work for a job with unknown metadata
+FAIR_SHARE_PENALTY = 120  # Seconds each recent request pushes a user's next one back
+USER_RATE_LIMIT = 20  # Requests a user may make per USER_RATE_WINDOW
+USER_RATE_WINDOW = 60 * 60  # Seconds over which USER_RATE_LIMIT is counted
+PREFETCH_WORKERS = 2  # Metadata lookups for waiting requests, to price them
+JOB_STORE_PATH = "jobs.db"  # SQLite job queue shared by bot and worker processes
+JOB_LEASE_TIME = 60  # Seconds a claimed job stays leased without a heartbeat
+JOB_HEARTBEAT_INTERVAL = 5  # Seconds between lease renewals and cancel checks
+JOB_POLL_INTERVAL = 1  # Seconds between checks for waiting jobs
+JOB_MAX_ATTEMPTS = 3  # Times a job is retried after its process died
+JOB_HISTORY_TIME = 24 * 60 * 60  # Seconds finished jobs are kept in the store
+SCRATCH_DIR = "downloads"  # Where each job gets its own working directory
+DISK_BUDGET = 20 * 1024 * 1024 * 1024  # Scratch bytes all running jobs may use
+TMPFS_SCRATCH_DIR = None  # Optional RAM-backed scratch, e.g. "/dev/shm/iimeow"
+TMPFS_BUDGET = 1024 * 1024 * 1024  # Bytes of TMPFS_SCRATCH_DIR jobs may use
+TMPFS_MAX_JOB_SIZE = 200 * 1024 * 1024  # Largest job kept in TMPFS_SCRATCH_DIR
+HANDLER_WORKERS = 8  # Threads running command handlers, one chat at a time each
+HANDLER_QUEUE_SIZE = 1000  # Updates buffered before polling or the webhook waits
+WEBHOOK_URL = None  # Public URL Telegram posts updates to, enables webhook mode
+WEBHOOK_HOST = "127.0.0.1"  # Local address the webhook server listens on
+WEBHOOK_PORT = 8443  # Local port, behind a reverse proxy terminating HTTPS
+WEBHOOK_SECRET = None  # Optional secret Telegram sends with every update
+THUMBNAIL_SIZE = 320  # Longest side of video thumbnails, Telegram's maximum
+DOWNLOAD_FRAGMENTS = 4  # DASH/HLS fragments a download fetches at the same time
+DOWNLOAD_CHUNK_SIZE = 10 * 1024 * 1024  # Bytes per HTTP range request
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024  # Initial read size, yt-dlp grows it as needed
+BANDWIDTH_LIMIT = None  # Bytes per second shared by a process's downloads
+PLAYLIST_MAX_ITEMS = 50  # Most videos taken from one /playlist request
+PLAYLIST_PARALLELISM = 3  # Videos of one playlist downloaded at the same time
+METRICS_HOST = "127.0.0.1"  # Address of the Prometheus metrics endpoint
+METRICS_PORT = 9100  # First port tried for /metrics, None disables it
+JOB_TRACE_PATH = "job_trace.jsonl"  # Per-job timing events, None disables them
+TELEGRAM_API_URL = (
+    None  # Bot API server, e.g. a local telegram-bot-api, None for Telegram's
+)
+
+
+# Settings holding text although they default to None
+TEXT_SETTINGS = {
+    "WEBHOOK_URL",
+    "WEBHOOK_SECRET",
+    "TMPFS_SCRATCH_DIR",
+    "TELEGRAM_API_URL",
+}
+
+
+def apply_env_config(settings, prefix="IIMEOW_"):
+    """Override configuration constants from <prefix><NAME> environment variables.
+
+    Text settings take the value as it is, the others parse it as JSON, so
+    numbers are written plainly and None as null.
+    """
+    for name, default in list(settings.items()):
+        value = os.environ.get(prefix + name)
+        if not name.isupper() or value is None:
+            continue
+        if not isinstance(default, str) and name not in TEXT_SETTINGS:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                if default is not None:
+                    raise ValueError(f"{prefix}{name} must be JSON, got {value!r}")
+        settings[name] = value
+
+
+apply_env_config(globals())
+
+
+class ChatDispatcher:
+    """Runs update handlers on a bounded thread pool, in order within a chat.
+
+    Every chat has its own FIFO of pending updates and runs at most one of
+    them at a time, so a slow handler only holds up its own chat. After each
+    update a busy chat goes to the back of the pool's queue, letting other
+    chats take turns. submit blocks while max_pending updates are waiting,
+    which slows down polling or the webhook instead of buffering forever.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.chats = {}  # chat key -> deque of pending tasks while scheduled
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, chat_key, task):
+        self.slots.acquire()
+        with self.lock:
+            pending = self.chats.get(chat_key)
+            if pending is not None:
+                pending.append(task)
+                return
+            self.chats[chat_key] = deque([task])
+        self.executor.submit(self.run_next, chat_key)
+
+    def run_next(self, chat_key):
+        """Run a chat's oldest pending update"""
+        with self.lock:
+            task = self.chats[chat_key].popleft()
+        try:
+            task()
+        except Exception as e:
+            print(f"Error handling update: {e}")
+        finally:
+            self.slots.release()
+
+        with self.lock:
+            if self.chats[chat_key]:
+                self.executor.submit(self.run_next, chat_key)
+            else:
+                del self.chats[chat_key]
+
+
+class DispatchingTeleBot(telebot.TeleBot):
+    """TeleBot that hands polled or webhook updates to the chat dispatcher"""
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            self.last_update_id = max(self.last_update_id, update.update_id)
+            message = update.message or update.edited_message
+            chat_key = message.chat.id if message else ("update", update.update_id)
+            update_dispatcher.submit(
+                chat_key, partial(super().process_new_updates, [update])
+            )
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in Prometheus' text format"""
+
+    BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.kinds = {}  # name -> (type, help text), in declaration order
+        self.gauges = {}  # name -> function reading the current value
+        self.values = {}  # (name, labels) -> counter value or histogram counts
+
+    def describe(self, kind, name, text, read=None):
+        self.kinds[name] = (kind, text)
+        if read:
+            self.gauges[name] = read
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a histogram sample, counts are kept cumulative per bucket"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(self.BUCKETS) + 2))
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        def sample(name, labels, value):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            if label_text:
+                label_text = f"{{{label_text}}}"
+            return f"{self.prefix}{name}{label_text} {value}"
+
+        with self.lock:
+            values = {
+                key: list(value) if isinstance(value, list) else value
+                for key, value in self.values.items()
+            }
 
-# Thread-safe queues and tracking
-download_queue = Queue()
-waiting_queue = Queue(maxsize=MAX_QUEUE_SIZE)
-user_downloads = {}  # Stores (message_id, cancel_event) tuple
-download_lock = threading.Lock()
-queue_lock = threading.Lock()
+        lines = []
+        for name, (kind, text) in self.kinds.items():
+            lines.append(f"# HELP {self.prefix}{name} {text}")
+            lines.append(f"# TYPE {self.prefix}{name} {kind}")
+            if kind == "gauge":
+                try:
+                    lines.append(sample(name, (), self.gauges[name]()))
+                except Exception as e:
+                    print(f"Error reading metric {name}: {e}")
+                continue
+
+            for (metric, labels), value in values.items():
+                if metric != name:
+                    continue
+                if kind == "counter":
+                    lines.append(sample(name, labels, value))
+                    continue
+                for bound, count in zip(self.BUCKETS, value):
+                    lines.append(
+                        sample(f"{name}_bucket", labels + (("le", bound),), count)
+                    )
+                lines.append(
+                    sample(f"{name}_bucket", labels + (("le", "+Inf"),), value[-1])
+                )
+                lines.append(sample(f"{name}_sum", labels, value[-2]))
+                lines.append(sample(f"{name}_count", labels, value[-1]))
+        return "\n".join(lines) + "\n"
 
-bot = telebot.TeleBot(API_TOKEN)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics to Prometheus"""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Thread-safe queues and tracking, one queue per pipeline stage
+extract_queue = Queue()  # Bounded by MAX_ACTIVE_JOBS admission
+download_queue = Queue(maxsize=STAGE_QUEUE_SIZE)
+split_queue = Queue(maxsize=STAGE_QUEUE_SIZE)
+upload_queue = Queue(maxsize=STAGE_QUEUE_SIZE)
+in_flight_jobs = {}  # Stores job_id -> DownloadJob run by this process
+user_requests = {}  # Stores user_id -> deque of recent request times
+download_lock = threading.RLock()
+metadata_cache = OrderedDict()  # Stores video_id -> (timestamp, info_dict)
+metadata_extractions = {}  # Stores video_id -> Future of a running extraction
+metadata_lock = threading.Lock()
+file_id_lock = threading.Lock()
+
+# Shared by every job so the number of running ffmpeg processes stays bounded
+split_executor = ThreadPoolExecutor(max_workers=SPLIT_WORKERS)
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+
+update_dispatcher = ChatDispatcher(HANDLER_WORKERS, HANDLER_QUEUE_SIZE)
+bot = DispatchingTeleBot(API_TOKEN, threaded=False)  # Handlers run in the dispatcher
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL.rstrip("/") + "/file/bot{0}/{1}"
+
+# Telegram file_id reuse cache: (video_id, mode, quality) -> uploaded parts
+file_id_db = sqlite3.connect(FILE_ID_CACHE_PATH, check_same_thread=False)
+file_id_db.execute("""
+    CREATE TABLE IF NOT EXISTS file_ids (
+        video_id TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        quality TEXT NOT NULL,
+        title TEXT,
+        file_ids TEXT NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (video_id, mode, quality)
+    )
+    """)
+file_id_db.commit()
+
+# Leases are taken in the name of this process
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Waiting jobs a playlist queued itself only start while fewer than
+# PLAYLIST_PARALLELISM jobs of the same playlist are running
+BATCH_HAS_ROOM = (
+    "(batch_id IS NULL OR (SELECT COUNT(*) FROM jobs AS sibling "
+    "WHERE sibling.batch_id = jobs.batch_id AND sibling.state = 'running') < ?)"
+)
+
+
+class JobStore:
+    """Durable job queue in SQLite, shared by every bot and worker process.
+
+    Jobs wait ordered by priority (arrival time plus expected cost, see
+    get_job_cost) until a process claims them with a lease. The owner keeps
+    renewing the lease while the job runs; a job whose owner crashed or
+    stopped heartbeating is claimed again by any process once its lease
+    runs out. Subscribers, their status messages and the parts they already
+    received are stored too, so a resumed job picks up where it stopped.
+
+    A playlist is a batch: its videos are ordinary jobs, and every
+    subscription made for it points at the batch, which owns the one status
+    message showing progress over all of them.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_key TEXT NOT NULL,
+                url TEXT NOT NULL,
+                is_audio INTEGER NOT NULL,
+                max_parts INTEGER NOT NULL,
+                state TEXT NOT NULL,
+                priority REAL NOT NULL,
+                created REAL NOT NULL,
+                owner TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                closed INTEGER NOT NULL DEFAULT 0,
+                scratch_dir TEXT,
+                disk_reserved INTEGER NOT NULL DEFAULT 0,
+                status TEXT,
+                sent_parts TEXT NOT NULL DEFAULT '[]',
+                batch_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, priority);
+            CREATE INDEX IF NOT EXISTS jobs_by_key ON jobs (job_key, state);
+            CREATE TABLE IF NOT EXISTS subscribers (
+                job_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                cancelled INTEGER NOT NULL DEFAULT 0,
+                parts_sent INTEGER NOT NULL DEFAULT 0,
+                batch_id INTEGER,
+                PRIMARY KEY (job_id, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS subscribers_by_user ON subscribers (user_id);
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                title TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            """)
+        # Stores created before playlists existed lack the batch columns
+        for table in ("jobs", "subscribers"):
+            columns = [row[1] for row in self.db.execute(f"PRAGMA table_info({table})")]
+            if "batch_id" not in columns:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN batch_id INTEGER")
+        self.db.executescript("""
+            CREATE INDEX IF NOT EXISTS jobs_by_batch ON jobs (batch_id, state);
+            CREATE INDEX IF NOT EXISTS subscribers_by_batch ON subscribers (batch_id);
+            """)
+
+    def subscribe(
+        self,
+        key,
+        url,
+        is_audio,
+        max_parts,
+        user_id,
+        message,
+        cost,
+        limit=None,
+        batch_id=None,
+        throttle=False,
+    ):
+        """Subscribe a user to the open job for a key, or create a waiting one.
+
+        Runs inside the caller's transaction. With a limit, raises queue.Full
+        instead of creating a job when that many requests are waiting.
+        batch_id files the subscription under a playlist, and throttle counts
+        a job created here against that playlist's PLAYLIST_PARALLELISM.
+        Returns (job_id, status of the job).
+        """
+        job_key = json.dumps(key)
+        row = self.db.execute(
+            "SELECT id, status FROM jobs WHERE job_key = ? "
+            "AND state IN ('waiting', 'running') AND NOT closed",
+            (job_key,),
+        ).fetchone()
+        if row is None:
+            if limit is not None and self.count_requests() >= limit:
+                raise queue.Full
+            now = time.time()
+            cursor = self.db.execute(
+                "INSERT INTO jobs (job_key, url, is_audio, max_parts, "
+                "state, priority, created, batch_id) "
+                "VALUES (?, ?, ?, ?, 'waiting', ?, ?, ?)",
+                (
+                    job_key,
+                    url,
+                    is_audio,
+                    max_parts,
+                    now + cost,
+                    now,
+                    batch_id if throttle else None,
+                ),
+            )
+            row = (cursor.lastrowid, None)
+        self.db.execute(
+            "INSERT OR REPLACE INTO subscribers "
+            "(job_id, user_id, chat_id, message_id, batch_id) VALUES (?, ?, ?, ?, ?)",
+            (row[0], user_id, message.chat.id, message.message_id, batch_id),
+        )
+        return row
+
+    def count_requests(self):
+        """Count waiting requests, a playlist counting as a single one"""
+        return self.db.execute(
+            "SELECT COUNT(DISTINCT COALESCE(-batch_id, id)) FROM jobs "
+            "WHERE state = 'waiting'"
+        ).fetchone()[0]
+
+    def submit(self, key, url, is_audio, max_parts, user_id, message, cost=0):
+        """Subscribe a user to an open job for the key, creating it if needed.
+
+        Returns (job_id, status of the job). Raises queue.Full when a new
+        job would have more than MAX_QUEUE_SIZE requests waiting.
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.subscribe(
+                    key,
+                    url,
+                    is_audio,
+                    max_parts,
+                    user_id,
+                    message,
+                    cost,
+                    limit=MAX_QUEUE_SIZE,
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return row
+
+    def submit_batch(self, user_id, message, title, items):
+        """Queue a playlist's videos as one batch sharing a status message.
+
+        items are (key, url, is_audio, cost, throttle) tuples. Returns the
+        batch ID, raises queue.Full if MAX_QUEUE_SIZE requests are waiting.
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                if self.count_requests() >= MAX_QUEUE_SIZE:
+                    raise queue.Full
+                batch_id = self.db.execute(
+                    "INSERT INTO batches (user_id, chat_id, message_id, title, "
+                    "created) VALUES (?, ?, ?, ?, ?)",
+                    (user_id, message.chat.id, message.message_id, title, time.time()),
+                ).lastrowid
+                for key, url, is_audio, cost, throttle in items:
+                    self.subscribe(
+                        key,
+                        url,
+                        is_audio,
+                        1,
+                        user_id,
+                        message,
+                        cost,
+                        batch_id=batch_id,
+                        throttle=throttle,
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return batch_id
+
+    def get_batch(self, batch_id):
+        """Return (chat_id, message_id, title, {state: videos}) of a batch.
+
+        Videos the user cancelled count as cancelled, whatever their job did.
+        """
+        with self.lock:
+            chat_id, message_id, title = self.db.execute(
+                "SELECT chat_id, message_id, title FROM batches WHERE id = ?",
+                (batch_id,),
+            ).fetchone()
+            rows = self.db.execute(
+                "SELECT CASE WHEN cancelled THEN 'cancelled' ELSE state END, "
+                "COUNT(*) FROM subscribers JOIN jobs ON jobs.id = job_id "
+                "WHERE subscribers.batch_id = ? GROUP BY 1",
+                (batch_id,),
+            ).fetchall()
+        return chat_id, message_id, title, dict(rows)
+
+    def find_batch(self, user_id):
+        """Return the ID of a user's playlist with videos left, or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT subscribers.batch_id FROM subscribers "
+                "JOIN jobs ON jobs.id = job_id "
+                "WHERE user_id = ? AND subscribers.batch_id IS NOT NULL "
+                "AND NOT cancelled AND state IN ('waiting', 'running')",
+                (user_id,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def claim(self, owner, limit):
+        """Lease up to limit waiting or abandoned jobs to the owner.
+
+        Claims are conditional updates, so processes racing for the same job
+        can't both win it.
+        """
+        now = time.time()
+        claimed = []
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, url, is_audio, max_parts, attempts, status, "
+                "sent_parts, created, state FROM jobs "
+                f"WHERE (state = 'waiting' AND {BATCH_HAS_ROOM}) "
+                "OR (state = 'running' AND lease_until < ?) "
+                "ORDER BY state = 'waiting', priority LIMIT ?",
+                (PLAYLIST_PARALLELISM, now, limit),
+            ).fetchall()
+            for job_id, url, is_audio, max_parts, attempts, *row, state in rows:
+                # The room is checked again per job, as earlier claims used it
+                cursor = self.db.execute(
+                    "UPDATE jobs SET state = 'running', owner = ?, "
+                    "lease_until = ?, attempts = attempts + 1 WHERE id = ? "
+                    f"AND state = ? AND ((state = 'waiting' AND {BATCH_HAS_ROOM}) "
+                    "OR lease_until < ?)",
+                    (
+                        owner,
+                        now + JOB_LEASE_TIME,
+                        job_id,
+                        state,
+                        PLAYLIST_PARALLELISM,
+                        now,
+                    ),
+                )
+                if cursor.rowcount:
+                    claimed.append(
+                        (job_id, url, is_audio, max_parts, attempts + 1, *row)
+                    )
+        return claimed
+
+    def heartbeat(self, owner, job_ids):
+        """Renew the owner's leases and return the jobs it still holds"""
+        if not job_ids:
+            return set()
+        marks = ", ".join("?" * len(job_ids))
+        with self.lock:
+            self.db.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE owner = ? "
+                f"AND state = 'running' AND id IN ({marks})",
+                (time.time() + JOB_LEASE_TIME, owner, *job_ids),
+            )
+            rows = self.db.execute(
+                f"SELECT id FROM jobs WHERE owner = ? AND state = 'running' "
+                f"AND id IN ({marks})",
+                (owner, *job_ids),
+            ).fetchall()
+        return {job_id for (job_id,) in rows}
+
+    def reserve_disk(self, job_id, scratch_dir, size, limit):
+        """Reserve scratch space for a job if running jobs leave enough room.
+
+        Jobs stop counting against the budget once they are no longer running,
+        including jobs of processes that died, when another process claims them.
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                (used,) = self.db.execute(
+                    "SELECT COALESCE(SUM(disk_reserved), 0) FROM jobs "
+                    "WHERE state = 'running' AND scratch_dir = ? AND id != ?",
+                    (scratch_dir, job_id),
+                ).fetchone()
+                reserved = used + size <= limit
+                if reserved:
+                    self.db.execute(
+                        "UPDATE jobs SET scratch_dir = ?, disk_reserved = ? "
+                        "WHERE id = ?",
+                        (scratch_dir, size, job_id),
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return reserved
+
+    def count_waiting(self):
+        with self.lock:
+            return self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'waiting'"
+            ).fetchone()[0]
+
+    def open_job_ids(self):
+        """Return the IDs of every waiting or running job"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id FROM jobs WHERE state IN ('waiting', 'running')"
+            ).fetchall()
+        return {job_id for (job_id,) in rows}
+
+    def get_owner(self, job_id):
+        """Return (state, owner) of a job"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT state, owner FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+
+    def finish(self, job_id, owner, state):
+        """Close a job the owner still holds as done, failed or cancelled"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET state = ?, lease_until = NULL "
+                "WHERE id = ? AND owner = ? AND state = 'running'",
+                (state, job_id, owner),
+            )
+
+    def close(self, job_id):
+        """Stop subscribing users to a job, later requests start a new one"""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET closed = 1 WHERE id = ?", (job_id,))
+
+    def purge(self, age):
+        """Delete jobs that ended more than age seconds after being created"""
+        ended = "SELECT id FROM jobs WHERE state NOT IN ('waiting', 'running')"
+        with self.lock:
+            self.db.execute(
+                f"DELETE FROM subscribers WHERE job_id IN ({ended} AND created < ?)",
+                (time.time() - age,),
+            )
+            self.db.execute(
+                "DELETE FROM jobs WHERE state NOT IN ('waiting', 'running') "
+                "AND created < ?",
+                (time.time() - age,),
+            )
+            self.db.execute(
+                "DELETE FROM batches WHERE created < ? AND NOT EXISTS "
+                "(SELECT 1 FROM subscribers WHERE batch_id = batches.id)",
+                (time.time() - age,),
+            )
+
+    def get_subscribers(self, job_id):
+        """Return (user_id, chat_id, message_id, cancelled, parts_sent,
+        batch_id) rows"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT user_id, chat_id, message_id, cancelled, parts_sent, "
+                "batch_id FROM subscribers WHERE job_id = ?",
+                (job_id,),
+            ).fetchall()
+
+    def set_status(self, job_id, text, state=None):
+        """Record a job's status text, optionally only while in a given state"""
+        with self.lock:
+            return self.db.execute(
+                "UPDATE jobs SET status = ? WHERE id = ? "
+                "AND (? IS NULL OR state = ?)",
+                (text, job_id, state, state),
+            ).rowcount
+
+    def set_sent_parts(self, job_id, sent_parts):
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET sent_parts = ? WHERE id = ?",
+                (json.dumps(sent_parts), job_id),
+            )
+
+    def set_parts_sent(self, job_id, user_id, parts_sent):
+        with self.lock:
+            self.db.execute(
+                "UPDATE subscribers SET parts_sent = ? "
+                "WHERE job_id = ? AND user_id = ?",
+                (parts_sent, job_id, user_id),
+            )
+
+    def reprioritize(self, job_id, cost):
+        """Re-rank a waiting job from its arrival time and a new cost"""
+        with self.lock:
+            self.db.execute(
+                "UPDATE jobs SET priority = created + ? "
+                "WHERE id = ? AND state = 'waiting'",
+                (cost, job_id),
+            )
+
+    def find_user(self, user_id):
+        """Return (job_id, state) of the open job a user waits on, or None"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT jobs.id, jobs.state FROM subscribers "
+                "JOIN jobs ON jobs.id = subscribers.job_id "
+                "WHERE user_id = ? AND NOT cancelled "
+                "AND state IN ('waiting', 'running')",
+                (user_id,),
+            ).fetchone()
+
+    def position(self, user_id):
+        """Return the 1-based queue position of a user's waiting job, or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*) FROM jobs AS other JOIN jobs AS mine "
+                "ON other.state = 'waiting' AND other.priority <= mine.priority "
+                "JOIN subscribers ON subscribers.job_id = mine.id "
+                "WHERE mine.state = 'waiting' AND user_id = ? AND NOT cancelled",
+                (user_id,),
+            ).fetchone()
+        return row[0] or None
+
+    def cancel(self, user_id):
+        """Cancel a user's subscriptions, and jobs nobody else waits on.
+
+        Returns (job_id, state, chat_id, message_id, batch_id) of the
+        cancelled jobs.
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    "SELECT jobs.id, state, chat_id, message_id, "
+                    "subscribers.batch_id FROM subscribers "
+                    "JOIN jobs ON jobs.id = subscribers.job_id "
+                    "WHERE user_id = ? AND NOT cancelled "
+                    "AND state IN ('waiting', 'running')",
+                    (user_id,),
+                ).fetchall()
+                for job_id, *_ in rows:
+                    self.db.execute(
+                        "UPDATE subscribers SET cancelled = 1 "
+                        "WHERE job_id = ? AND user_id = ?",
+                        (job_id, user_id),
+                    )
+                    self.db.execute(
+                        "UPDATE jobs SET state = 'cancelled' WHERE id = ? "
+                        "AND NOT EXISTS (SELECT 1 FROM subscribers "
+                        "WHERE job_id = ? AND NOT cancelled)",
+                        (job_id, job_id),
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return rows
+
+
+class TokenBucket:
+    """Token bucket rate limiter, callers hold the owner's lock"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0  # Set from Telegram's retry_after
+
+    def delay(self):
+        """Return the seconds until a token is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, amount=1):
+        self.tokens -= amount
+
+
+class RateLimitStore:
+    """Bot API token buckets in SQLite, shared by every bot and worker process.
+
+    The global bucket and one bucket per chat are rows refilled from the
+    wall clock. A call takes its tokens in one immediate transaction, so
+    processes can't both spend the last token, and a chat blocked by
+    Telegram's retry_after is blocked for every process.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                bucket TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                blocked_until REAL NOT NULL DEFAULT 0
+            )
+            """)
+
+    def take(self, chat_id):
+        """Return the seconds until a chat may send, taking a token if it can"""
+        limits = {
+            "global": (TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE),
+            f"chat:{chat_id}": (TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST),
+        }
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                rows = {
+                    bucket: (tokens, updated, blocked_until)
+                    for bucket, tokens, updated, blocked_until in self.db.execute(
+                        "SELECT bucket, tokens, updated, blocked_until "
+                        "FROM rate_limits WHERE bucket IN (?, ?)",
+                        tuple(limits),
+                    )
+                }
+                buckets = {}
+                delay = 0
+                for bucket, (rate, capacity) in limits.items():
+                    tokens, updated, blocked_until = rows.get(
+                        bucket, (capacity, now, 0)
+                    )
+                    tokens = min(capacity, tokens + (now - updated) * rate)
+                    buckets[bucket] = [tokens, blocked_until]
+                    if now < blocked_until:
+                        delay = max(delay, blocked_until - now)
+                    elif tokens < 1:
+                        delay = max(delay, (1 - tokens) / rate)
+                for bucket, (tokens, blocked_until) in buckets.items():
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?)",
+                        (
+                            bucket,
+                            tokens - 1 if delay <= 0 else tokens,
+                            now,
+                            blocked_until,
+                        ),
+                    )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return delay
+
+    def block(self, chat_id, seconds):
+        """Keep every process from calling in a chat for seconds"""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO rate_limits VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (bucket) DO UPDATE SET blocked_until = excluded.blocked_until",
+                (f"chat:{chat_id}", TELEGRAM_CHAT_BURST, now, now + seconds),
+            )
+
+    def purge(self):
+        """Forget chats whose bucket is full again and which aren't blocked"""
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM rate_limits WHERE bucket != 'global' "
+                "AND updated < ? AND blocked_until < ?",
+                (now - TELEGRAM_CHAT_BURST / TELEGRAM_CHAT_RATE, now),
+            )
+
+
+class BandwidthAllocator:
+    """Splits BANDWIDTH_LIMIT between running downloads, max-min fair.
+
+    Downloads report what they received and sleep off anything beyond their
+    share. Shares are recomputed every second from measured speeds: a
+    download held back by its source keeps a little more than it uses and
+    the rest of the link is split between the others.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.buckets = {}  # key -> TokenBucket refilled at the download's share
+        self.received = {}  # key -> bytes since the last rebalance
+        self.rebalanced = time.monotonic()
+
+    def add(self, key):
+        if not self.limit:
+            return
+        with self.lock:
+            self.buckets[key] = TokenBucket(self.limit, self.limit)
+            self.received[key] = 0
+            self.rebalance(measured=False)
+
+    def remove(self, key):
+        with self.lock:
+            if self.buckets.pop(key, None):
+                self.received.pop(key)
+                self.rebalance(measured=False)
+
+    def throttle(self, key, amount):
+        """Account for received bytes, sleeping while over the share"""
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return
+            bucket.consume(amount)
+            self.received[key] += amount
+            if time.monotonic() - self.rebalanced >= 1:
+                self.rebalance()
+            delay = bucket.delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def rebalance(self, measured=True):
+        """Hand out shares, slowest first, callers hold the lock"""
+        now = time.monotonic()
+        elapsed = now - self.rebalanced
+        speeds = {}
+        if measured and elapsed > 0:
+            speeds = {key: got / elapsed for key, got in self.received.items()}
+
+        left = self.limit
+        order = sorted(self.buckets, key=lambda key: speeds.get(key, math.inf))
+        for i, key in enumerate(order):
+            fair = left / (len(order) - i)
+            speed = speeds.get(key)
+            share = fair
+            if speed is not None and speed < 0.8 * fair:
+                share = max(speed * 1.25, fair / 10)
+            bucket = self.buckets[key]
+            bucket.delay()  # Refill at the old rate up to now
+            bucket.rate = bucket.capacity = share
+            bucket.tokens = min(bucket.tokens, share)
+            left -= share
+
+        self.received = dict.fromkeys(self.buckets, 0)
+        self.rebalanced = now
+
+
+class TelegramClient:
+    """Rate limited, retrying access to the Bot API shared by every thread.
+
+    Sends wait for a token from the global and per-chat buckets, which are
+    shared with the other processes through a RateLimitStore, and retry
+    with jittered backoff. Status edits are queued instead, so workers never
+    block on them, and pending edits to the same message are coalesced so
+    only the latest text is sent. A small pool sends them, one at a time per
+    message, so a slow edit doesn't hold up other chats' status.
+    """
+
+    def __init__(self, bot, limits):
+        self.bot = bot
+        self.limits = limits
+        self.lock = threading.Condition()
+        self.pending_edits = OrderedDict()  # (chat_id, message_id) -> text
+        self.sent_edits = OrderedDict()  # (chat_id, message_id) -> text shown
+        self.editing = set()  # (chat_id, message_id) of edits being sent
+        self.edit_retries = {}  # (chat_id, message_id) -> (failures, retry time)
+        self.edit_executor = ThreadPoolExecutor(max_workers=TELEGRAM_EDIT_WORKERS)
+        threading.Thread(target=self.edit_loop, daemon=True).start()
+
+    def wait_for_token(self, chat_id):
+        with self.lock:
+            while True:
+                delay = self.limits.take(chat_id)
+                if delay <= 0:
+                    return
+                self.lock.wait(delay)
+
+    def handle_rate_limit(self, chat_id, error):
+        """Pause a chat for as long as Telegram's retry_after asks"""
+        retry_after = (error.result_json.get("parameters") or {}).get("retry_after", 1)
+        metrics.inc("telegram_rate_limits_total")
+        print(f"Telegram rate limit hit, retrying after {retry_after}s")
+        self.limits.block(chat_id, retry_after)
+        with self.lock:
+            self.lock.notify_all()
+
+    def call(self, chat_id, method, *args, **kwargs):
+        """Call a Bot API method, honoring rate limits and retrying failures"""
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            self.wait_for_token(chat_id)
+            try:
+                return method(*args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 429:
+                    metrics.inc("telegram_errors_total", code=e.error_code)
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                if e.error_code == 429:
+                    self.handle_rate_limit(chat_id, e)
+                elif e.error_code < 500:
+                    raise
+                else:
+                    time.sleep(retry_delay(attempt))
+            except requests.exceptions.RequestException:
+                metrics.inc("telegram_errors_total", code="network")
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                time.sleep(retry_delay(attempt))
+
+            # Uploads read the files, rewind them before sending again
+            for arg in (*args, *kwargs.values()):
+                if hasattr(arg, "seek"):
+                    arg.seek(0)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.call(message.chat.id, self.bot.reply_to, message, text, **kwargs)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.call(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    def send_audio(self, chat_id, audio, **kwargs):
+        return self.call(chat_id, self.bot.send_audio, chat_id, audio, **kwargs)
+
+    def send_video(self, chat_id, video, **kwargs):
+        return self.call(chat_id, self.bot.send_video, chat_id, video, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id):
+        """Queue a status edit, replacing any pending edit of the same message"""
+        with self.lock:
+            self.pending_edits[(chat_id, message_id)] = text
+            self.lock.notify_all()
+
+    def next_edit(self):
+        """Pick a pending edit that may be sent now, taking its tokens.
+
+        Returns (key, None), or (None, seconds to wait before looking again).
+        Called with the lock held.
+        """
+        if len(self.editing) >= TELEGRAM_EDIT_WORKERS:
+            return None, None
+        now = time.monotonic()
+        wait = None
+        for key, text in list(self.pending_edits.items()):
+            if key in self.editing:
+                continue  # Sent in order, after the edit in flight
+            if self.sent_edits.get(key) == text:
+                self.pending_edits.pop(key)  # Already showing
+                continue
+            retry_time = self.edit_retries.get(key, (0, 0))[1]
+            delay = retry_time - now if retry_time > now else self.limits.take(key[0])
+            if delay <= 0:
+                return key, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def edit_loop(self):
+        """Hand queued edits to the edit pool as the rate limits allow"""
+        while True:
+            with self.lock:
+                key, wait = self.next_edit()
+                if key is None:
+                    self.lock.wait(wait)
+                    continue
+                text = self.pending_edits.pop(key)
+                self.editing.add(key)
+            self.edit_executor.submit(self.send_edit, key, text)
+
+    def send_edit(self, key, text):
+        try:
+            self.bot.edit_message_text(
+                text, key[0], key[1], timeout=TELEGRAM_EDIT_TIMEOUT
+            )
+            with self.lock:
+                self.sent_edits[key] = text
+                while len(self.sent_edits) > TELEGRAM_TRACKED_CHATS:
+                    self.sent_edits.popitem(last=False)
+                self.edit_retries.pop(key, None)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                self.handle_rate_limit(key[0], e)
+                with self.lock:
+                    self.pending_edits.setdefault(key, text)
+            elif "message is not modified" not in e.description:
+                metrics.inc("telegram_errors_total", code=e.error_code)
+                print(f"Error updating status: {e}")
+                if e.error_code >= 500:
+                    self.retry_edit(key, text)
+        except requests.exceptions.RequestException as e:
+            metrics.inc("telegram_errors_total", code="network")
+            print(f"Error updating status: {e}")
+            self.retry_edit(key, text)
+        except Exception as e:
+            print(f"Error updating status: {e}")
+        finally:
+            with self.lock:
+                self.editing.discard(key)
+                self.lock.notify_all()
+
+    def retry_edit(self, key, text):
+        """Queue a failed edit again after a backoff, unless a newer one is queued"""
+        with self.lock:
+            failures, _ = self.edit_retries.pop(key, (0, 0))
+            if failures >= TELEGRAM_MAX_RETRIES:
+                print(f"Giving up on status update of message {key[1]}")
+                return
+            retry_time = time.monotonic() + retry_delay(failures)
+            self.edit_retries[key] = (failures + 1, retry_time)
+            self.pending_edits.setdefault(key, text)
+
+
+def retry_delay(attempt):
+    """Jittered exponential backoff before retrying a failed Bot API call"""
+    return min(30, 2**attempt) * random.uniform(0.5, 1.5)
+
+
+# Every outbound Bot API call goes through the shared rate limited client,
+# within limits every process keeps in the job store's database
+telegram = TelegramClient(bot, RateLimitStore(JOB_STORE_PATH))
+
+# Downloads of this process share the link through one allocator
+bandwidth = BandwidthAllocator(BANDWIDTH_LIMIT)
+
+# Queued and running jobs live in the job store, not in process memory
+job_store = JobStore(JOB_STORE_PATH)
+
+metrics = Metrics("iimeow_")
+metrics.describe("histogram", "queue_wait_seconds", "Time jobs waited in the job store")
+metrics.describe(
+    "histogram", "stage_wait_seconds", "Time jobs waited for a pipeline stage"
+)
+metrics.describe("histogram", "stage_seconds", "Time jobs spent in a pipeline stage")
+metrics.describe(
+    "histogram",
+    "step_seconds",
+    "Time spent waiting for parts, sending, remuxing and so on",
+)
+metrics.describe("counter", "jobs_total", "Jobs finished by final state")
+metrics.describe("counter", "download_bytes_total", "Bytes downloaded")
+metrics.describe("counter", "upload_bytes_total", "Bytes uploaded to Telegram")
+metrics.describe("counter", "cache_lookups_total", "Cache lookups by cache and result")
+metrics.describe("counter", "telegram_errors_total", "Failed Bot API calls by code")
+metrics.describe(
+    "counter", "telegram_rate_limits_total", "Bot API calls rejected with 429"
+)
+metrics.describe(
+    "gauge", "active_jobs", "Jobs run by this process", lambda: len(in_flight_jobs)
+)
+metrics.describe(
+    "gauge",
+    "waiting_jobs",
+    "Jobs waiting in the store",
+    lambda: job_store.count_waiting(),
+)
+metrics.describe(
+    "gauge",
+    "scratch_free_bytes",
+    "Free space where jobs download",
+    lambda: shutil.disk_usage(SCRATCH_DIR if os.path.isdir(SCRATCH_DIR) else ".").free,
+)
+trace_lock = threading.Lock()
+
+
+def trace_job(job, event, **fields):
+    """Append a structured timing event for a job to the trace log"""
+    if not JOB_TRACE_PATH:
+        return
+    record = {
+        "time": round(time.time(), 3),
+        "worker": WORKER_ID,
+        "job": job.job_id,
+        "event": event,
+        **fields,
+    }
+    with trace_lock, open(JOB_TRACE_PATH, "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+def start_metrics_server():
+    """Serve /metrics on the first free port from METRICS_PORT, one per process"""
+    if METRICS_PORT is None:
+        return
+    for port in range(METRICS_PORT, METRICS_PORT + 16):
+        try:
+            server = http.server.ThreadingHTTPServer(
+                (METRICS_HOST, port), MetricsHandler
+            )
+        except OSError:
+            continue
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on {METRICS_HOST}:{port}/metrics")
+        return
+    print("No free port for the metrics endpoint")
 
 
 def clear_screen():
@@ -32,50 +1224,212 @@ def clear_screen():
     print("Dev: @s4rrar")
 
 
-def check_file_size(url):
+def check_file_size(info, estimated_size=None):
     """Check if the file size is within limits before downloading"""
     try:
-        with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
-            info = ydl.extract_info(url, download=False)
-            if info.get("filesize"):
-                return info["filesize"] <= MAX_FILE_SIZE
-            # If filesize not available, check formatted size
-            formats = info.get("formats", [])
-            max_size = 0
-            for f in formats:
-                if f.get("filesize"):
-                    max_size = max(max_size, f["filesize"])
-            return max_size <= MAX_FILE_SIZE
+        if estimated_size:
+            return estimated_size <= MAX_FILE_SIZE
+        if info.get("filesize"):
+            return info["filesize"] <= MAX_FILE_SIZE
+        # If filesize not available, check formatted size
+        formats = info.get("formats", [])
+        max_size = 0
+        for f in formats:
+            if f.get("filesize"):
+                max_size = max(max_size, f["filesize"])
+        return max_size <= MAX_FILE_SIZE
     except:
         return True  # If size check fails, allow download attempt
 
 
-def process_waiting_queue():
-    """Process users in waiting queue when a slot becomes available"""
-    with queue_lock:
-        if not waiting_queue.empty() and len(user_downloads) < MAX_CONCURRENT_DOWNLOADS:
-            try:
-                task = waiting_queue.get_nowait()
-                user_id, message, url, is_audio, cancel_event = task
-
-                # Notify user their download is starting
-                bot.edit_message_text(
-                    "Your turn has arrived! Starting download... 🔄",
-                    message.chat.id,
-                    message.message_id,
-                )
+def estimate_format_size(fmt, duration):
+    """Estimate a format's size in bytes from filesize, filesize_approx or tbr"""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if not size and fmt.get("tbr") and duration:
+        size = fmt["tbr"] * 1000 / 8 * duration
+    return size
 
-                # Add to active downloads
-                with download_lock:
-                    user_downloads[user_id] = (message.message_id, cancel_event)
 
-                # Add to download queue
-                download_queue.put(task)
+def select_video_format(info, max_parts=1):
+    """Pick the best video format that fits in max_parts Telegram uploads.
 
-                return True
-            except:
-                return False
-    return False
+    Returns (format spec, estimated size). When no format is known to fit,
+    falls back to VIDEO_FORMAT and the file gets split after downloading.
+    """
+    duration = info.get("duration")
+    formats = info.get("formats") or []
+    if max_parts > 1:
+        # Parts are planned to stay SPLIT_HEADROOM under the limit when splitting
+        budget = max_parts * (MAX_TELEGRAM_SIZE - SPLIT_HEADROOM)
+    else:
+        budget = MAX_TELEGRAM_SIZE * 0.95  # Room for size estimate errors
+
+    # Best audio-only stream that can be merged into an MP4
+    audio = None
+    for fmt in formats:
+        if fmt.get("vcodec") == "none" and fmt.get("ext") == "m4a":
+            size = estimate_format_size(fmt, duration)
+            if size and (audio is None or (fmt.get("tbr") or 0) > audio[1]):
+                audio = (fmt, fmt.get("tbr") or 0, size)
+
+    best = None
+    for fmt in formats:
+        if fmt.get("vcodec") in (None, "none") or fmt.get("ext") != "mp4":
+            continue
+        size = estimate_format_size(fmt, duration)
+        if not size:
+            continue
+
+        if fmt.get("acodec") not in (None, "none"):
+            spec = fmt["format_id"]
+        elif audio:
+            spec = f"{fmt['format_id']}+{audio[0]['format_id']}"
+            size += audio[2]
+        else:
+            continue
+
+        rank = (fmt.get("height") or 0, fmt.get("tbr") or 0)
+        if size <= budget and (best is None or rank > best[0]):
+            best = (rank, spec, size)
+
+    if best is None:
+        return VIDEO_FORMAT, None
+    return best[1], best[2]
+
+
+def estimate_job_cost(info, is_audio, max_parts=1):
+    """Estimate the seconds a job keeps the pipeline busy from its info_dict"""
+    duration = info.get("duration") or 0
+    if is_audio:
+        # The source audio is downloaded, then encoded and uploaded as MP3
+        size = 2 * duration * int(AUDIO_QUALITY) * 1000 / 8
+    else:
+        size = select_video_format(info, max_parts)[1]
+        if size is None:
+            # Nothing fits, so the download gets split: roughly a second pass
+            size = estimate_format_size(info, duration)
+            size = 2 * size if size else DEFAULT_JOB_COST * SCHEDULER_THROUGHPUT
+    return size / SCHEDULER_THROUGHPUT
+
+
+def check_rate_limit(user_id):
+    """Record a user's request, returns False if they are over their quota"""
+    now = time.monotonic()
+    with download_lock:
+        times = user_requests.setdefault(user_id, deque())
+        while times and now - times[0] > USER_RATE_WINDOW:
+            times.popleft()
+        if len(times) >= USER_RATE_LIMIT:
+            return False
+        times.append(now)
+        return True
+
+
+def admit_request(message, user_id):
+    """Check a new download or playlist request, replying if it is refused"""
+    if job_store.find_user(user_id):
+        telegram.reply_to(
+            message,
+            "❌ You already have a download in progress. Use /cancel to stop it.",
+        )
+        return False
+
+    if not check_rate_limit(user_id):
+        telegram.reply_to(
+            message,
+            f"❌ You can make up to {USER_RATE_LIMIT} requests per "
+            f"{USER_RATE_WINDOW // 60} minutes. Please try again later.",
+        )
+        return False
+    return True
+
+
+def get_job_cost(user_id, url, is_audio, max_parts=1):
+    """Expected cost in seconds used to order a request in the waiting queue"""
+    if SCHEDULER_POLICY == "fifo":
+        return 0
+
+    info = peek_video_info(url)
+    cost = estimate_job_cost(info, is_audio, max_parts) if info else DEFAULT_JOB_COST
+
+    # Users who asked for a lot recently yield to those who haven't
+    with download_lock:
+        recent = len(user_requests.get(user_id, ()))
+    return cost + FAIR_SHARE_PENALTY * max(0, recent - 1)
+
+
+def prefetch_job_cost(job_id, user_id, url, is_audio, max_parts=1):
+    """Fetch a waiting job's metadata, then move it to its real place"""
+    try:
+        get_video_info(url)  # Also saves the extract stage the lookup later
+    except Exception as e:
+        print(f"Couldn't prefetch metadata for {url}: {e}")
+        return
+    job_store.reprioritize(job_id, get_job_cost(user_id, url, is_audio, max_parts))
+
+
+def claim_jobs():
+    """Lease waiting jobs from the store while this process has free slots"""
+    with download_lock:
+        free = MAX_ACTIVE_JOBS - len(in_flight_jobs)
+        rows = job_store.claim(WORKER_ID, free) if free > 0 else []
+        claimed = []
+        for row in rows:
+            job_id, url, is_audio, max_parts, attempts, status, sent_parts, created = (
+                row
+            )
+            job = DownloadJob(job_id, url, bool(is_audio), max_parts)
+            job.sent_parts = [tuple(part) for part in json.loads(sent_parts)]
+            in_flight_jobs[job_id] = job
+            claimed.append((job, attempts, status, created))
+
+    for job, attempts, status, created in claimed:
+        queue_wait = time.time() - created
+        if attempts == 1:
+            metrics.observe("queue_wait_seconds", queue_wait)
+        trace_job(job, "claimed", attempt=attempts, queue_wait=round(queue_wait, 3))
+
+        job.sync()
+        if attempts - 1 > JOB_MAX_ATTEMPTS:  # The first claim isn't a retry
+            job.update_status(
+                "❌ Download failed after repeated interruptions. Please try again."
+            )
+            job_store.finish(job.job_id, WORKER_ID, "failed")
+            metrics.inc("jobs_total", state="failed")
+            with download_lock:
+                in_flight_jobs.pop(job.job_id, None)
+            continue
+
+        if attempts > 1:
+            job.update_status("🔄 Resuming your download after a restart...")
+        elif status:  # Users were told they are waiting in the queue
+            job.update_status("Your turn has arrived! Starting download... 🔄")
+        job.queued_at = time.monotonic()
+        extract_queue.put(job)
+    return bool(claimed)
+
+
+def job_keeper():
+    """Claim waiting jobs, renew leases and pick up changes from other processes"""
+    last_heartbeat = 0
+    while True:
+        try:
+            claim_jobs()
+            if time.monotonic() - last_heartbeat >= JOB_HEARTBEAT_INTERVAL:
+                last_heartbeat = time.monotonic()
+                with download_lock:
+                    jobs = list(in_flight_jobs.values())
+                held = job_store.heartbeat(WORKER_ID, [job.job_id for job in jobs])
+                for job in jobs:
+                    job.sync()
+                    if job.job_id not in held:
+                        # Cancelled, or leased to another process after we stalled
+                        job.cancel_event.set()
+                job_store.purge(JOB_HISTORY_TIME)
+                telegram.limits.purge()
+        except Exception as e:
+            print(f"Job store error: {e}")
+        time.sleep(JOB_POLL_INTERVAL)
 
 
 def extract_video_id(url):
@@ -98,351 +1452,1585 @@ def get_clean_video_url(url):
     return url
 
 
-def get_media_duration(filename):
-    """Get media duration using ffprobe"""
+class YoutubeDLPool:
+    """Long-lived YoutubeDL instances, one per thread and kind of download.
+
+    Building a YoutubeDL loads every extractor, and each instance keeps its
+    own HTTP session, so reusing them saves that setup and keeps connections
+    to the same servers open between jobs. Options that change from job to
+    job are applied to the instance for the length of a single call.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.hooks = {}  # (thread, kind) -> progress hook of the running call
+
+    def get(self, kind):
+        instances = getattr(self.local, "instances", None)
+        if instances is None:
+            instances = self.local.instances = {}
+        if kind not in instances:
+            key = (threading.get_ident(), kind)
+            options = {
+                "quiet": True,
+                "outtmpl": "%(title).150B.%(ext)s",
+                # Forwards progress to the running call's hook, also from
+                # the threads yt-dlp downloads fragments on
+                "progress_hooks": [partial(self.progress_hook, key)],
+            }
+            if kind == "audio":
+                options["format"] = "bestaudio/best"
+                options["postprocessors"] = [
+                    {
+                        "key": "FFmpegExtractAudio",
+                        "preferredcodec": "mp3",
+                        "preferredquality": AUDIO_QUALITY,
+                    }
+                ]
+            elif kind == "video":
+                options["merge_output_format"] = "mp4"
+            elif kind == "playlist":
+                # Only list the entries, without extracting every video,
+                # and stop paging through long playlists at the cap
+                options["extract_flat"] = "in_playlist"
+                options["playlistend"] = PLAYLIST_MAX_ITEMS
+            if kind in ("audio", "video"):
+                options.update(
+                    {
+                        "concurrent_fragment_downloads": DOWNLOAD_FRAGMENTS,
+                        "http_chunk_size": DOWNLOAD_CHUNK_SIZE,
+                        "buffersize": DOWNLOAD_BUFFER_SIZE,
+                        # Pick .part files up again, e.g. when a job resumes
+                        "continuedl": True,
+                    }
+                )
+            instances[kind] = yt_dlp.YoutubeDL(options)
+        return instances[kind]
+
+    def progress_hook(self, key, status):
+        hook = self.hooks.get(key)
+        if hook:
+            hook(status)
+
+    def discard(self, kind):
+        """Close an instance, the next call on this thread builds a new one"""
+        ydl = self.local.instances.pop(kind, None)
+        if ydl:
+            ydl.close()
+
+    def extract_info(self, url, kind="info"):
+        try:
+            return self.get(kind).extract_info(url, download=False)
+        except Exception:
+            self.discard(kind)
+            raise
+
+    def download(self, info, kind, video_format=None, workdir=None, hook=None):
+        """Download an extracted info_dict, returning the processed result"""
+        ydl = self.get(kind)
+        if video_format:
+            ydl.format_selector = ydl.build_format_selector(video_format)
+        ydl.params["paths"] = {"home": workdir} if workdir else {}
+        key = (threading.get_ident(), kind)
+        self.hooks[key] = hook
+        try:
+            return ydl.process_ie_result(info, download=True)
+        except Exception:
+            # A cancelled or failed transfer may leave the instance half way
+            self.discard(kind)
+            raise
+        finally:
+            self.hooks.pop(key, None)
+
+
+ydl_pool = YoutubeDLPool()
+
+
+def get_video_info(url):
+    """Extract video metadata once, reusing a cached info_dict when possible.
+
+    Concurrent lookups of the same video wait for the first one's
+    extraction instead of starting their own.
+    """
+    cache_key = extract_video_id(url) or url
+    now = time.monotonic()
+
+    with metadata_lock:
+        cached = metadata_cache.get(cache_key)
+        if cached and now - cached[0] < METADATA_CACHE_TTL:
+            metadata_cache.move_to_end(cache_key)
+            metrics.inc("cache_lookups_total", cache="metadata", result="hit")
+            return copy.deepcopy(cached[1])
+        metadata_cache.pop(cache_key, None)
+        extraction = metadata_extractions.get(cache_key)
+        if extraction is None:
+            extraction = metadata_extractions[cache_key] = Future()
+            running = False
+        else:
+            running = True
+
+    if running:
+        metrics.inc("cache_lookups_total", cache="metadata", result="shared")
+        # Raises the first lookup's error too
+        return copy.deepcopy(extraction.result())
+    metrics.inc("cache_lookups_total", cache="metadata", result="miss")
+
+    # Without the private keys, such as the requested_formats the info pass
+    # picked, so a download re-selects its own format like yt-dlp's --load-info
+    try:
+        info = yt_dlp.YoutubeDL.sanitize_info(
+            ydl_pool.extract_info(url), remove_private_keys=True
+        )
+    except Exception as e:
+        with metadata_lock:
+            del metadata_extractions[cache_key]
+        extraction.set_exception(e)
+        raise
+
+    with metadata_lock:
+        metadata_cache[cache_key] = (now, info)
+        while len(metadata_cache) > METADATA_CACHE_SIZE:
+            metadata_cache.popitem(last=False)
+        del metadata_extractions[cache_key]
+    extraction.set_result(info)
+
+    # Callers get their own copy since yt-dlp mutates it while downloading
+    return copy.deepcopy(info)
+
+
+def peek_video_info(url):
+    """Return cached metadata without extracting it, or None.
+
+    The info_dict is shared with the cache, callers must not modify it.
+    """
+    cache_key = extract_video_id(url) or url
+    with metadata_lock:
+        cached = metadata_cache.get(cache_key)
+        if cached and time.monotonic() - cached[0] < METADATA_CACHE_TTL:
+            return cached[1]
+    return None
+
+
+def get_cache_quality(is_audio, max_parts=1):
+    """Return the quality key uploads are cached under for a download mode"""
+    return f"mp3-{AUDIO_QUALITY}" if is_audio else f"fit-{max_parts}"
+
+
+def get_cached_file_ids(video_id, is_audio, max_parts=1):
+    """Look up previously uploaded Telegram file_ids, returns (title, file_ids)"""
+    mode = "audio" if is_audio else "video"
+    with file_id_lock:
+        row = file_id_db.execute(
+            "SELECT title, file_ids FROM file_ids "
+            "WHERE video_id = ? AND mode = ? AND quality = ?",
+            (video_id, mode, get_cache_quality(is_audio, max_parts)),
+        ).fetchone()
+        metrics.inc(
+            "cache_lookups_total", cache="file_id", result="hit" if row else "miss"
+        )
+        if not row:
+            return None
+        file_id_db.execute(
+            "UPDATE file_ids SET last_used = ? "
+            "WHERE video_id = ? AND mode = ? AND quality = ?",
+            (time.time(), video_id, mode, get_cache_quality(is_audio, max_parts)),
+        )
+        file_id_db.commit()
+    return row[0], json.loads(row[1])
+
+
+def store_file_ids(video_id, is_audio, title, file_ids, max_parts=1):
+    """Remember the ordered file_ids of a successful upload"""
+    mode = "audio" if is_audio else "video"
+    with file_id_lock:
+        file_id_db.execute(
+            "INSERT OR REPLACE INTO file_ids "
+            "(video_id, mode, quality, title, file_ids, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                video_id,
+                mode,
+                get_cache_quality(is_audio, max_parts),
+                title,
+                json.dumps(file_ids),
+                time.time(),
+            ),
+        )
+        # Evict least recently used entries beyond the cache size
+        file_id_db.execute(
+            "DELETE FROM file_ids WHERE rowid IN ("
+            "SELECT rowid FROM file_ids ORDER BY last_used DESC "
+            "LIMIT -1 OFFSET ?)",
+            (FILE_ID_CACHE_SIZE,),
+        )
+        file_id_db.commit()
+
+
+def forget_file_ids(video_id, is_audio, max_parts=1):
+    """Drop a cached upload, e.g. when Telegram no longer accepts its file_ids"""
+    mode = "audio" if is_audio else "video"
+    with file_id_lock:
+        file_id_db.execute(
+            "DELETE FROM file_ids WHERE video_id = ? AND mode = ? AND quality = ?",
+            (video_id, mode, get_cache_quality(is_audio, max_parts)),
+        )
+        file_id_db.commit()
+
+
+def send_media(chat_id, media, caption, is_audio, **options):
+    """Send a file or cached file_id and return the resulting Telegram file_id"""
+    if is_audio:
+        sent = telegram.send_audio(chat_id, media, caption=caption, **options)
+    else:
+        sent = telegram.send_video(chat_id, media, caption=caption, **options)
+    # Telegram may store the upload as a document instead of a video/audio
+    uploaded = sent.audio or sent.video or sent.document
+    return uploaded.file_id if uploaded else None
+
+
+def run_ffmpeg(cmd, cancel_event=None):
+    """Run an ffmpeg command, terminating it as soon as the job is cancelled.
+
+    Returns the exit code, or None if the process was cancelled.
+    """
+    with subprocess.Popen(
+        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    ) as process:
+        while True:
+            try:
+                return process.wait(timeout=0.2)
+            except subprocess.TimeoutExpired:
+                if cancel_event and cancel_event.is_set():
+                    process.terminate()
+                    process.wait()
+                    return None
+
+
+def encode_audio_part(
+    input_file, output_file, start_time, duration, bitrate, cancel_event=None
+):
+    """Re-encode one part of an audio file, only used when stream copy fails"""
     cmd = [
-        "ffprobe",
-        "-v",
-        "error",
-        "-show_entries",
-        "format=duration",
-        "-of",
-        "default=noprint_wrappers=1:nokey=1",
-        filename,
+        "ffmpeg",
+        "-ss",
+        str(start_time),
+        "-i",
+        input_file,
+        "-t",
+        str(duration),
+        "-c:a",
+        "libmp3lame",  # Use MP3 codec
+        "-b:a",
+        f"{bitrate}k",  # Set audio bitrate
+        output_file,
+        "-y",
+    ]
+    run_ffmpeg(cmd, cancel_event)
+
+
+def copy_audio_part(
+    input_file, output_file, start_time, duration, bitrate, cancel_event=None
+):
+    """Cut one part of an MP3 at frame boundaries without re-encoding it"""
+    cmd = [
+        "ffmpeg",
+        "-ss",
+        str(start_time),
+        "-i",
+        input_file,
+        "-t",
+        str(duration),
+        "-map",
+        "0:a:0",
+        "-c",
+        "copy",
+        output_file,
+        "-y",
     ]
+
     try:
-        output = subprocess.check_output(cmd).decode().strip()
-        return float(output)
-    except:
-        return None
+        run_ffmpeg(cmd, cancel_event)
+        if (
+            not (cancel_event and cancel_event.is_set())
+            and os.path.exists(output_file)
+            and 0 < os.path.getsize(output_file) <= MAX_TELEGRAM_SIZE
+        ):
+            return output_file
+
+        # Stream copy should always fit, re-encode a lower bitrate as last resort
+        if not (cancel_event and cancel_event.is_set()):
+            print(f"Stream copy of {output_file} failed or is too large, re-encoding")
+            encode_audio_part(
+                input_file,
+                output_file,
+                start_time,
+                duration,
+                bitrate * 2 // 3,
+                cancel_event,
+            )
+        if (
+            not (cancel_event and cancel_event.is_set())
+            and os.path.exists(output_file)
+            and 0 < os.path.getsize(output_file) <= MAX_TELEGRAM_SIZE
+        ):
+            return output_file
+    except Exception as e:
+        print(f"Error splitting audio: {e}")
+
+    if os.path.exists(output_file):
+        os.remove(output_file)  # Clean up failed attempt
+    return None
 
 
-def split_audio(input_file, max_size=MAX_TELEGRAM_SIZE):
-    """Split an audio file into parts that fit within Telegram's size limit"""
+def plan_audio_split(
+    input_file,
+    duration=None,
+    bitrate=int(AUDIO_QUALITY),
+    cancel_event=None,
+    max_size=MAX_TELEGRAM_SIZE,
+):
+    """Plan the (job, duration) of each part of an oversized MP3.
+
+    The MP3 was encoded once at a constant bitrate when it was extracted, so
+    its size follows from the duration and the other way around, and no
+    probing is needed. Every part is cut with stream copy instead of being
+    transcoded a second time.
+    """
     if not os.path.exists(input_file):
         return []
 
     file_size = os.path.getsize(input_file)
-    if file_size <= max_size:
-        return [input_file]
+    duration = duration or file_size * 8 / (bitrate * 1000)
 
-    duration = get_media_duration(input_file)
-    if not duration:
-        return []
-
-    # Calculate number of parts needed with conservative sizing
-    safe_max_size = 45 * 1024 * 1024  # 45MB
-    num_parts = math.ceil(file_size / safe_max_size)
+    # Equal parts of a constant bitrate file each land just under the limit
+    expected_size = max(file_size, duration * bitrate * 1000 / 8)
+    num_parts = math.ceil(expected_size / (max_size - SPLIT_HEADROOM))
     segment_duration = duration / num_parts
 
-    output_files = []
-    for i in range(num_parts):
-        start_time = i * segment_duration
-        output_file = f"{input_file[:-4]}_part{i+1}.mp3"
-
-        cmd = [
-            "ffmpeg",
-            "-i",
-            input_file,
-            "-ss",
-            str(start_time),
-            "-t",
-            str(segment_duration),
-            "-c:a",
-            "libmp3lame",  # Use MP3 codec
-            "-b:a",
-            "192k",  # Set audio bitrate
-            output_file,
-            "-y",
-        ]
-
-        try:
-            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
-                if os.path.getsize(output_file) > safe_max_size:
-                    # If still too large, try again with lower bitrate
-                    cmd[5] = "128k"  # Reduce audio bitrate
-                    subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-                if (
-                    os.path.exists(output_file)
-                    and os.path.getsize(output_file) <= MAX_TELEGRAM_SIZE
-                ):
-                    output_files.append(output_file)
-                else:
-                    os.remove(output_file)  # Clean up failed attempt
-        except Exception as e:
-            print(f"Error splitting audio: {e}")
-            if os.path.exists(output_file):
-                os.remove(output_file)
+    base = os.path.splitext(input_file)[0]
+    return [
+        (
+            partial(
+                copy_audio_part,
+                input_file,
+                f"{base}_part{i+1}.mp3",
+                i * segment_duration,
+                segment_duration,
+                bitrate,
+                cancel_event=cancel_event,
+            ),
+            segment_duration,
+        )
+        for i in range(num_parts)
+    ]
 
-    return output_files
 
+def get_packet_index(input_file, cancel_event=None):
+    """List (pts_time, frame, size, is_keyframe) of every packet in one ffprobe pass.
 
-def split_video(input_file, max_size=MAX_TELEGRAM_SIZE):
-    """Split a video file into parts that fit within Telegram's size limit"""
-    if not os.path.exists(input_file):
+    frame is the video frame number of video packets and None for other streams.
+    """
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "packet=codec_type,pts_time,size,flags",
+        "-of",
+        "compact=p=0",
+        input_file,
+    ]
+    packets = []
+    frame = 0
+    try:
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+        ) as process:
+            for line in process.stdout:
+                if cancel_event and cancel_event.is_set():
+                    process.kill()
+                    return []
+                fields = dict(
+                    item.split("=", 1)
+                    for item in line.strip().split("|")
+                    if "=" in item
+                )
+                try:
+                    pts_time = float(fields["pts_time"])
+                    size = int(fields["size"])
+                except (KeyError, ValueError):
+                    continue
+                if fields.get("codec_type") == "video":
+                    is_keyframe = "K" in fields.get("flags", "")
+                    packets.append((pts_time, frame, size, is_keyframe))
+                    frame += 1
+                else:
+                    packets.append((pts_time, None, size, False))
+    except Exception as e:
+        print(f"Error probing packets: {e}")
         return []
+    return packets
 
-    file_size = os.path.getsize(input_file)
-    if file_size <= max_size:
-        return [input_file]
 
-    duration = get_media_duration(input_file)
-    if not duration:
-        return []
+def plan_keyframe_cuts(packets, max_part_size):
+    """Pick keyframes to cut at so every part stays below max_part_size.
 
-    safe_max_size = 45 * 1024 * 1024  # 45MB
-    num_parts = math.ceil(file_size / safe_max_size)
-    segment_duration = duration / num_parts
+    Parts get as long as their packets allow, so they vary in length with
+    the bitrate. Returns the (frame, pts_time) of each cut, or None when a
+    single GOP is already larger than a part and stream copy can't work.
+    """
+    if not packets:
+        return None
 
-    output_files = []
-    for i in range(num_parts):
-        start_time = i * segment_duration
-        output_file = f"{input_file[:-4]}_part{i+1}.mp4"
-
-        cmd = [
-            "ffmpeg",
-            "-i",
-            input_file,
-            "-ss",
-            str(start_time),
-            "-t",
-            str(segment_duration),
+    # Every packet also adds its entries to the MP4's sample tables
+    index_bytes = 16
+    cuts = []
+    part_bytes = 0  # Bytes since the last cut
+    keyframe = None  # Latest keyframe we could cut at
+    bytes_before_keyframe = 0  # Bytes of the current part before that keyframe
+
+    for pts_time, frame, size, is_keyframe in packets:
+        if is_keyframe and part_bytes > 0:
+            keyframe = (frame, pts_time)
+            bytes_before_keyframe = part_bytes
+        part_bytes += size + index_bytes
+
+        if part_bytes > max_part_size:
+            if keyframe is None:
+                return None
+            cuts.append(keyframe)
+            part_bytes -= bytes_before_keyframe
+            keyframe = None
+
+    return cuts
+
+
+def fit_video_bitrate(duration, max_size, source_bitrate=None):
+    """Video bitrate in kbps that fills max_size over duration seconds.
+
+    Leaves SPLIT_HEADROOM, 128k for the audio and 5% for the encoder missing
+    its target, and never goes above the source's own bitrate.
+    """
+    kbps = (max_size - SPLIT_HEADROOM) * 8 / duration / 1000 * 0.95 - 128
+    if source_bitrate:
+        kbps = min(kbps, source_bitrate)
+    return max(100, int(kbps))
+
+
+def reencode_video_part(
+    input_file,
+    output_file,
+    start_time,
+    duration,
+    max_size,
+    cancel_event=None,
+    video_bitrate=1500,
+):
+    """Re-encode one part of a video, used when stream copy can't fit the limit"""
+
+    def encode(video_bitrate):
+        # Seek on the input side so ffmpeg doesn't decode from the start
+        cmd = ["ffmpeg", "-ss", str(start_time), "-i", input_file]
+        if duration:
+            cmd += ["-t", str(duration)]
+        cmd += [
             "-c:v",
             "libx264",
             "-b:v",
-            "1500k",
+            f"{video_bitrate}k",
             "-c:a",
             "aac",
             "-b:a",
             "128k",
             "-max_muxing_queue_size",
             "1024",
+            "-movflags",
+            "+faststart",
             output_file,
             "-y",
         ]
+        return run_ffmpeg(cmd, cancel_event)
 
-        try:
-            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
-                if os.path.getsize(output_file) > safe_max_size:
-                    cmd[8] = "750k"  # Reduce video bitrate
-                    subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-                if (
-                    os.path.exists(output_file)
-                    and os.path.getsize(output_file) <= MAX_TELEGRAM_SIZE
-                ):
-                    output_files.append(output_file)
-                else:
-                    os.remove(output_file)
-        except Exception as e:
-            print(f"Error splitting video: {e}")
+    try:
+        if encode(video_bitrate) is None:
+            raise InterruptedError("Split cancelled")
+        if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+            size = os.path.getsize(output_file)
+            if size > max_size:
+                # Scale the bitrate down by how far the encoder overshot
+                print(f"Re-encoded {output_file} is too large, encoding again")
+                if encode(int(video_bitrate * max_size / size * 0.9)) is None:
+                    raise InterruptedError("Split cancelled")
+
+            if os.path.exists(output_file) and os.path.getsize(output_file) <= max_size:
+                return output_file
+            os.remove(output_file)
+    except Exception as e:
+        print(f"Error splitting video: {e}")
+        if os.path.exists(output_file):
+            os.remove(output_file)
+    return None
+
+
+def copy_video_part(
+    input_file, output_file, start_time, frames, duration, max_size, cancel_event=None
+):
+    """Cut one part of a video between two keyframes with stream copy"""
+    cmd = ["ffmpeg"]
+    if start_time > 0:
+        # Input seeking lands on the keyframe at or before the position
+        cmd += ["-ss", f"{start_time + 0.001:.6f}"]
+    cmd += ["-i", input_file, "-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"]
+    cmd += ["-frames:v", str(frames)]
+    if duration:
+        cmd += ["-t", f"{duration:.6f}"]
+    cmd += ["-avoid_negative_ts", "make_zero", "-movflags", "+faststart"]
+    cmd += [output_file, "-y"]
+
+    try:
+        if run_ffmpeg(cmd, cancel_event) is None:
             if os.path.exists(output_file):
                 os.remove(output_file)
+            return None
+        if os.path.exists(output_file) and 0 < os.path.getsize(output_file) <= max_size:
+            return output_file
+    except Exception as e:
+        print(f"Error splitting video: {e}")
+
+    print(f"Stream copy of {output_file} failed or is too large, re-encoding")
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    return reencode_video_part(
+        input_file,
+        output_file,
+        start_time,
+        duration,
+        max_size,
+        cancel_event,
+        fit_video_bitrate(duration, max_size) if duration else 1500,
+    )
+
+
+def plan_video_split(
+    input_file, max_size=MAX_TELEGRAM_SIZE, cancel_event=None, duration=None
+):
+    """Plan the (job, duration) of each part of an oversized video.
+
+    Parts are cut at keyframes with stream copy, falling back to re-encoding
+    only for parts that can't be made small enough that way. The one packet
+    probe also gives the duration and bitrate the fallback is sized with.
+    """
+    if not os.path.exists(input_file):
+        return []
+
+    safe_max_size = max_size - SPLIT_HEADROOM
+    base = os.path.splitext(input_file)[0]
+    packets = get_packet_index(input_file, cancel_event)
+    cuts = plan_keyframe_cuts(packets, safe_max_size)
+
+    if packets:
+        start = min(packet[0] for packet in packets)
+        end = max(packet[0] for packet in packets)
+        duration = end - start or duration
+
+    if cuts:
+        total_frames = sum(1 for packet in packets if packet[1] is not None)
+        bounds = [(0, start)] + cuts + [(total_frames, None)]
+        return [
+            (
+                partial(
+                    copy_video_part,
+                    input_file,
+                    f"{base}_part{i+1}.mp4",
+                    pts_time - start,
+                    next_frame - frame,
+                    next_time - pts_time if next_time is not None else None,
+                    max_size,
+                    cancel_event=cancel_event,
+                ),
+                (next_time if next_time is not None else end) - pts_time,
+            )
+            for i, ((frame, pts_time), (next_frame, next_time)) in enumerate(
+                zip(bounds, bounds[1:])
+            )
+        ]
+
+    if not duration:
+        return []
+
+    # Equal parts re-encoded at the bitrate that fills each of them
+    num_parts = math.ceil(os.path.getsize(input_file) / safe_max_size)
+    segment_duration = duration / num_parts
+    video_bytes = sum(packet[2] for packet in packets if packet[1] is not None)
+    source_bitrate = video_bytes * 8 / duration / 1000 if video_bytes else None
+    video_bitrate = fit_video_bitrate(segment_duration, max_size, source_bitrate)
+    return [
+        (
+            partial(
+                reencode_video_part,
+                input_file,
+                f"{base}_part{i+1}.mp4",
+                i * segment_duration,
+                segment_duration,
+                max_size,
+                cancel_event=cancel_event,
+                video_bitrate=video_bitrate,
+            ),
+            segment_duration,
+        )
+        for i in range(num_parts)
+    ]
+
+
+class SplitParts:
+    """Parts produced on the split pool, iterated in order as they finish.
+
+    Production starts right away and runs at most `lookahead` parts ahead of
+    the consumer, so disk usage stays bounded while the previous part is
+    being uploaded. Closing cancels pending parts and removes finished ones.
+    """
+
+    def __init__(self, part_jobs, lookahead=SPLIT_LOOKAHEAD):
+        self.jobs = iter(part_jobs)
+        self.pending = deque(
+            split_executor.submit(job) for job in islice(self.jobs, lookahead)
+        )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            raise StopIteration
+        part = self.pending.popleft().result()
+        next_job = next(self.jobs, None)
+        if next_job:
+            self.pending.append(split_executor.submit(next_job))
+        return part
+
+    def wait(self):
+        """Block until the next part is produced"""
+        if self.pending:
+            wait_futures([self.pending[0]])
+
+    def close(self):
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.cancel():
+                part = future.result()
+                if part and os.path.exists(part):
+                    os.remove(part)
+
+
+def get_download_dimensions(info_dict):
+    """Return the (width, height) of the file a processed info_dict describes"""
+    downloads = info_dict.get("requested_downloads") or [{}]
+    return downloads[0].get("width"), downloads[0].get("height")
+
+
+def is_faststart(filename):
+    """Check that an MP4's moov atom comes before its media data"""
+    with open(filename, "rb") as file:
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                return False
+            size, kind = struct.unpack(">I4s", header)
+            if kind == b"moov":
+                return True
+            if kind == b"mdat" or size == 0:
+                return False
+            if size == 1:  # 64-bit size follows the header
+                size = struct.unpack(">Q", file.read(8))[0] - 8
+            file.seek(size - 8, os.SEEK_CUR)
+
+
+def remux_faststart(filename, cancel_event=None):
+    """Move the moov atom to the front with a stream copy, in place"""
+    output_file = os.path.splitext(filename)[0] + ".faststart.mp4"
+    cmd = ["ffmpeg", "-i", filename, "-map", "0", "-c", "copy"]
+    cmd += ["-movflags", "+faststart", output_file, "-y"]
+    try:
+        if run_ffmpeg(cmd, cancel_event) is not None and os.path.exists(output_file):
+            os.replace(output_file, filename)
+            return True
+    except Exception as e:
+        print(f"Error remuxing video: {e}")
+    if os.path.exists(output_file):
+        os.remove(output_file)
+    return False
+
 
-    return output_files
+def make_thumbnail(filename, duration=None, cancel_event=None):
+    """Grab a JPEG thumbnail within Telegram's limits from a video frame"""
+    thumbnail = os.path.join(os.path.dirname(filename), "thumbnail.jpg")
+    position = min(duration * 0.1, 10) if duration else 0  # Skip black intros
+    cmd = ["ffmpeg", "-ss", str(position), "-i", filename, "-frames:v", "1"]
+    cmd += [
+        "-vf",
+        f"scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease",
+        "-q:v",
+        "5",
+        thumbnail,
+        "-y",
+    ]
+    try:
+        run_ffmpeg(cmd, cancel_event)
+        if os.path.exists(thumbnail) and 0 < os.path.getsize(thumbnail) <= 200 * 1024:
+            return thumbnail
+    except Exception as e:
+        print(f"Error making thumbnail: {e}")
+    return None
 
 
-def download_youtube_content(url, is_audio=False, cancel_event=None):
-    """Download YouTube content with progress updates and cancellation support"""
+def estimate_scratch_size(info, is_audio, estimated_size=None):
+    """Estimate the scratch space a job needs to download and split its file"""
+    duration = info.get("duration") or 0
+    if is_audio:
+        # The downloaded source audio and the MP3 made from it
+        size = 2 * duration * int(AUDIO_QUALITY) * 1000 / 8
+    else:
+        # Separate streams are kept until they are merged into the MP4
+        size = estimated_size or estimate_format_size(info, duration)
+        size = 2 * (size or MAX_TELEGRAM_SIZE)
+    if size > MAX_TELEGRAM_SIZE:
+        size += SPLIT_LOOKAHEAD * MAX_TELEGRAM_SIZE  # Parts waiting to be sent
+    return int(size)
+
+
+def reserve_workdir(job, size):
+    """Reserve scratch space for a job and create its working directory.
+
+    Small jobs go to TMPFS_SCRATCH_DIR when it has room, others wait for
+    DISK_BUDGET. Returns False if the job can never fit or gets cancelled.
+    """
+    scratch_dir = None
+    if TMPFS_SCRATCH_DIR and size <= TMPFS_MAX_JOB_SIZE:
+        if job_store.reserve_disk(job.job_id, TMPFS_SCRATCH_DIR, size, TMPFS_BUDGET):
+            scratch_dir = TMPFS_SCRATCH_DIR
+
+    if scratch_dir is None:
+        if size > DISK_BUDGET:
+            return False
+        waiting = False
+        while not job_store.reserve_disk(job.job_id, SCRATCH_DIR, size, DISK_BUDGET):
+            if not waiting:
+                job.update_status(f"💾 Waiting for disk space: {job.title}...")
+                waiting = True
+            if job.cancel_event.wait(JOB_POLL_INTERVAL):
+                return False
+        scratch_dir = SCRATCH_DIR
+
+    job.workdir = os.path.join(scratch_dir, f"job-{job.job_id}")
+    os.makedirs(job.workdir, exist_ok=True)
+    return True
+
+
+def sweep_scratch():
+    """Remove working directories left behind by jobs that are no longer open"""
+    open_jobs = job_store.open_job_ids()
+    for scratch_dir in (SCRATCH_DIR, TMPFS_SCRATCH_DIR):
+        if not scratch_dir or not os.path.isdir(scratch_dir):
+            continue
+        for name in os.listdir(scratch_dir):
+            match = re.fullmatch(r"job-(\d+)", name)
+            if match and int(match.group(1)) not in open_jobs:
+                shutil.rmtree(os.path.join(scratch_dir, name), ignore_errors=True)
+
+
+def download_youtube_content(
+    url,
+    is_audio=False,
+    cancel_event=None,
+    info=None,
+    video_format=VIDEO_FORMAT,
+    progress=None,
+    workdir=None,
+    throttle=None,
+):
+    """Download YouTube content with progress updates and cancellation support.
+
+    Files are written to workdir, or the current directory. Returns the
+    exact path of the final file and the processed info_dict, which
+    describes the format that was really downloaded, or (None, None).
+    throttle is called with every amount of bytes received and may sleep
+    to slow the download down.
+    """
+    temp_files = set()
+    received = {}  # Bytes reported so far per file being downloaded
     try:
         if not url.startswith(("http://", "https://")):
-            return None
+            return None, None
 
-        # Download configurations
-        if is_audio:
-            ydl_opts = {
-                "format": "bestaudio/best",
-                "outtmpl": "%(title)s.%(ext)s",
-                "postprocessors": [
-                    {
-                        "key": "FFmpegExtractAudio",
-                        "preferredcodec": "mp3",
-                        "preferredquality": "192",
-                    }
-                ],
-            }
+        if info is None:
+            info = get_video_info(url)
+
+        if cancel_event and cancel_event.is_set():
+            return None, None
+
+        # Abort the transfer from inside yt-dlp as soon as the job is cancelled,
+        # and record progress for the reporter, without any Telegram calls
+        def progress_hook(status):
+            for key in ("filename", "tmpfilename"):
+                if status.get(key):
+                    temp_files.add(status[key])
+            if cancel_event and cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled("Download cancelled by user")
+            if throttle and status.get("status") == "downloading":
+                downloaded = status.get("downloaded_bytes") or 0
+                name = status.get("filename")
+                amount = downloaded - received.get(name, 0)
+                if amount > 0:
+                    received[name] = downloaded
+                    throttle(amount)
+            if progress is not None and status.get("status") == "downloading":
+                progress.update(
+                    downloaded=status.get("downloaded_bytes") or 0,
+                    total=status.get("total_bytes")
+                    or status.get("total_bytes_estimate"),
+                    speed=status.get("speed"),
+                    eta=status.get("eta"),
+                    updated=time.monotonic(),
+                )
+
+        # Download from the already extracted info_dict on this thread's
+        # YoutubeDL, reusing its extractors and open connections
+        info_dict = ydl_pool.download(
+            info,
+            "audio" if is_audio else "video",
+            video_format=None if is_audio else video_format,
+            workdir=workdir,
+            hook=progress_hook,
+        )
+
+        # The final path, after merging the streams or extracting the audio
+        downloads = info_dict.get("requested_downloads")
+        return downloads[0].get("filepath") if downloads else None, info_dict
+    except Exception as e:
+        print(f"Error downloading: {e}")
+        if cancel_event and cancel_event.is_set():
+            # Remove partial downloads, including fragment and resume files
+            for temp_file in temp_files:
+                for path in glob.glob(glob.escape(temp_file) + "*"):
+                    os.remove(path)
+        return None, None
+
+
+class Subscriber:
+    """A user waiting on a download job, with their own status message.
+
+    Subscribers from a playlist share the playlist's status message instead.
+    """
+
+    def __init__(self, user_id, chat_id, message_id, parts_sent=0, batch_id=None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.cancel_event = threading.Event()
+        self.parts_sent = parts_sent
+        self.batch_id = batch_id
+
+
+class DownloadJob:
+    """A single download shared by every user who requested the same video"""
+
+    def __init__(self, job_id, url, is_audio, max_parts=1):
+        self.job_id = job_id
+        self.url = url
+        self.is_audio = is_audio
+        self.max_parts = max_parts  # Parts the user accepts for a better quality
+        self.cancel_event = threading.Event()  # Set once every subscriber cancelled
+        self.subscribers = []
+        self.sent_parts = []  # (file_id, caption) of every part sent so far
+        self.status = None
+        self.completed = False
+        self.title = None
+        self.video_id = None
+        self.info = None
+        self.video_format = None
+        self.filename = None
+        self.workdir = None  # Scratch directory holding every file of the job
+        self.width = None
+        self.height = None
+        self.thumbnail = None
+        self.parts = None  # SplitParts of an oversized file, in production
+        self.part_durations = None
+        self.timings = {}  # Seconds spent in each stage and step
+        self.queued_at = None  # When the job was put into its stage queue
+        self.progress = None  # Live download progress while downloading
+        self.progress_shown = None  # When the shown progress was recorded
+        self.lock = threading.Lock()
+
+    def sync(self):
+        """Pick up subscribers that joined or cancelled, maybe in another process"""
+        rows = job_store.get_subscribers(self.job_id)
+        with self.lock:
+            known = {sub.user_id: sub for sub in self.subscribers}
+            for user_id, chat_id, message_id, cancelled, parts_sent, batch_id in rows:
+                sub = known.get(user_id)
+                if cancelled:
+                    if sub:
+                        sub.cancel_event.set()
+                elif sub is None or sub.message_id != message_id:
+                    # New, or cancelled and then requested the video again
+                    if sub:
+                        self.subscribers.remove(sub)
+                    self.subscribers.append(
+                        Subscriber(user_id, chat_id, message_id, parts_sent, batch_id)
+                    )
+        self.check_cancelled()
+
+    def active_subscribers(self):
+        with self.lock:
+            return [s for s in self.subscribers if not s.cancel_event.is_set()]
+
+    def check_cancelled(self):
+        """Abort the job once its last subscriber has cancelled"""
+        with self.lock:
+            if all(s.cancel_event.is_set() for s in self.subscribers):
+                self.cancel_event.set()
+
+    def drop_cancelled(self):
+        """Tell cancelled subscribers their download stopped and release them"""
+        with self.lock:
+            cancelled = [s for s in self.subscribers if s.cancel_event.is_set()]
+            self.subscribers = [s for s in self.subscribers if s not in cancelled]
+
+        for sub in cancelled:
+            if sub.batch_id is None:  # /cancel updates playlist messages
+                telegram.edit_message_text(
+                    "❌ Download cancelled.", sub.chat_id, sub.message_id
+                )
+
+    def update_status(self, text):
+        """Show the same status text to every subscriber"""
+        self.drop_cancelled()
+        with self.lock:
+            self.status = text
+        job_store.set_status(self.job_id, text)
+        for sub in self.active_subscribers():
+            if sub.batch_id is None:
+                telegram.edit_message_text(text, sub.chat_id, sub.message_id)
+            else:
+                show_batch_status(sub.batch_id)
+
+    def catch_up(self, sub):
+        """Send a late subscriber the parts everyone else already received"""
+        with self.lock:
+            missing = self.sent_parts[sub.parts_sent :]
+        for file_id, caption in missing:
+            send_media(sub.chat_id, file_id, caption, self.is_audio)
+            sub.parts_sent += 1
+            job_store.set_parts_sent(self.job_id, sub.user_id, sub.parts_sent)
+
+    def add_timing(self, step, seconds):
+        self.timings[step] = self.timings.get(step, 0) + seconds
+
+    def upload_options(self, duration=None):
+        """Metadata sent with an upload so clients can show and stream it"""
+        if self.is_audio:
+            options = {"title": self.title, "performer": self.info.get("uploader")}
         else:
-            ydl_opts = {
-                "format": "best[ext=mp4]/best",  # Simplified format selection
-                "outtmpl": "%(title)s.%(ext)s",
+            options = {
+                "width": self.width,
+                "height": self.height,
+                "supports_streaming": True,
             }
+        options["duration"] = round(duration) if duration else None
+        return {key: value for key, value in options.items() if value is not None}
+
+    def send_part(self, filename, caption, duration=None):
+        """Upload a part once and fan its file_id out to every subscriber"""
+        file_id = None
+        for sub in self.active_subscribers():
+            if self.cancel_event.is_set():
+                break
+            self.catch_up(sub)
+            if file_id is None:
+                options = self.upload_options(duration)
+                metrics.inc("upload_bytes_total", os.path.getsize(filename))
+                with open(filename, "rb") as file:
+                    if self.thumbnail:
+                        options["thumbnail"] = open(self.thumbnail, "rb")
+                    try:
+                        file_id = send_media(
+                            sub.chat_id, file, caption, self.is_audio, **options
+                        )
+                    finally:
+                        if self.thumbnail:
+                            options["thumbnail"].close()
+            else:
+                send_media(sub.chat_id, file_id, caption, self.is_audio)
+            sub.parts_sent += 1
+            job_store.set_parts_sent(self.job_id, sub.user_id, sub.parts_sent)
+
+        with self.lock:
+            self.sent_parts.append((file_id, caption))
+            job_store.set_sent_parts(self.job_id, self.sent_parts)
+        return file_id
+
+    def close(self):
+        """Stop accepting new subscribers, later requests start a new job"""
+        job_store.close(self.job_id)
+        self.sync()  # Everyone who got in before closing
+
+    def deliver(self):
+        """Make sure every remaining subscriber has received all parts"""
+        for sub in self.active_subscribers():
+            self.catch_up(sub)
+
+    def finish(self):
+        """Record how the job ended so its subscribers are free again"""
+        if self.completed:
+            state = "done"
+        elif self.cancel_event.is_set():
+            state = "cancelled"
+        else:
+            state = "failed"
+        job_store.finish(self.job_id, WORKER_ID, state)
+        for sub in self.active_subscribers():
+            if sub.batch_id is not None:
+                show_batch_status(sub.batch_id)
+        metrics.inc("jobs_total", state=state)
+        trace_job(
+            self,
+            "finished",
+            state=state,
+            timings={step: round(seconds, 3) for step, seconds in self.timings.items()},
+        )
+        self.drop_cancelled()
+
+
+def format_progress(title, progress):
+    """Render a progress record as status text"""
+    text = f"⏳ Downloading: {title}..."
+    downloaded = progress.get("downloaded") or 0
+    total = progress.get("total")
+    if total:
+        percent = min(100, downloaded * 100 / total)
+        filled = int(percent // 10)
+        text += f"\n{'█' * filled}{'░' * (10 - filled)} {percent:.0f}% of {total / 1024 / 1024:.1f}MB"
+    elif downloaded:
+        text += f"\n{downloaded / 1024 / 1024:.1f}MB downloaded"
+
+    speed = progress.get("speed")
+    if speed:
+        text += f"\n⚡ {speed / 1024 / 1024:.1f}MB/s"
+        eta = progress.get("eta")
+        if eta is not None:
+            text += f" • ETA {int(eta) // 60}:{int(eta) % 60:02d}"
+    return text
+
+
+def format_batch_status(title, counts):
+    """Render a playlist's progress over all of its videos as status text"""
+    total = sum(counts.values())
+    done = counts.get("done", 0)
+    running = counts.get("running", 0)
+    waiting = counts.get("waiting", 0)
+    if running or waiting:
+        text = (
+            f"📋 Playlist: {title}\n✅ {done}/{total} sent"
+            f" • ⏳ {running} downloading • ⌛ {waiting} waiting"
+        )
+    elif counts.get("cancelled"):
+        text = f"🛑 Playlist cancelled: {title}\n✅ {done}/{total} sent"
+    else:
+        text = f"✅ Playlist completed: {title}\n✅ {done}/{total} sent"
+    if counts.get("failed"):
+        text += f" • ❌ {counts['failed']} failed"
+    return text
 
-        if cancel_event and cancel_event.is_set():
-            return None
 
-        # Download the content
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+def show_batch_status(batch_id):
+    """Refresh a playlist's shared status message"""
+    chat_id, message_id, title, counts = job_store.get_batch(batch_id)
+    telegram.edit_message_text(format_batch_status(title, counts), chat_id, message_id)
+
+
+def progress_reporter():
+    """Render live download progress into status messages at a bounded rate"""
+    while True:
+        time.sleep(PROGRESS_UPDATE_INTERVAL)
+        with download_lock:
+            jobs = list(in_flight_jobs.values())
+
+        for job in jobs:
+            progress = job.progress
+            if progress and progress.get("updated") != job.progress_shown:
+                job.progress_shown = progress.get("updated")
+                text = format_progress(job.title, progress)
+                if job.progress is progress:  # Still downloading
+                    job.update_status(text)
 
-        # Get the downloaded filename
-        info_dict = ydl.extract_info(url, download=False)
-        filename = ydl.prepare_filename(info_dict)
-        filename = filename.replace(
-            filename.split(".")[-1], "mp3" if is_audio else "mp4"
+
+def find_user_job(user_id):
+    """Return the in-flight job a user is subscribed to, if any"""
+    with download_lock:
+        jobs = list(in_flight_jobs.values())
+    for job in jobs:
+        if any(sub.user_id == user_id for sub in job.active_subscribers()):
+            return job
+    return None
+
+
+def get_job_key(url, is_audio, max_parts=1):
+    """Identify identical requests by canonical video ID, mode and part budget"""
+    video_id = extract_video_id(url) or get_clean_video_url(url)
+    return video_id, "audio" if is_audio else "video", max_parts
+
+
+def submit_download(user_id, message, url, is_audio, max_parts=1, cost=0):
+    """Queue a download job, or subscribe to an identical one already open.
+
+    Returns (job_id, status of the job), raises queue.Full if the waiting
+    queue has no room for a new job.
+    """
+    key = get_job_key(url, is_audio, max_parts)
+    job_id, status = job_store.submit(
+        key, url, is_audio, max_parts, user_id, message, cost
+    )
+
+    # A job this process is running picks its new subscriber up right away
+    with download_lock:
+        job = in_flight_jobs.get(job_id)
+    if job:
+        job.sync()
+    return job_id, status
+
+
+def get_playlist_url(url):
+    """Convert a YouTube URL with a list parameter to the playlist's URL"""
+    parsed_url = urlparse(url)
+    list_id = parse_qs(parsed_url.query).get("list", [None])[0]
+    if list_id and parsed_url.hostname in ("www.youtube.com", "youtube.com"):
+        return f"https://www.youtube.com/playlist?list={list_id}"
+    return url
+
+
+def submit_playlist(user_id, message, url, is_audio):
+    """List a playlist with one flat extraction and queue its videos as a batch.
+
+    Videos already uploaded before are queued first and outside the batch's
+    parallelism, as their jobs only re-send the stored file_ids.
+    """
+    try:
+        info = ydl_pool.extract_info(get_playlist_url(url), "playlist")
+    except Exception as e:
+        telegram.edit_message_text(
+            f"❌ Couldn't read the playlist: {e}", message.chat.id, message.message_id
+        )
+        return
+
+    items = {}
+    for entry in info.get("entries") or []:
+        video_url = entry and (entry.get("webpage_url") or entry.get("url"))
+        if not video_url or not video_url.startswith(("http://", "https://")):
+            continue
+        key = get_job_key(video_url, is_audio)
+        if key in items:
+            continue
+        video_id = extract_video_id(video_url)
+        if video_id and get_cached_file_ids(video_id, is_audio):
+            items[key] = (key, video_url, is_audio, 0, False)
+        else:
+            # Later videos yield to other users, like separate requests would
+            cost = 0
+            if SCHEDULER_POLICY != "fifo":
+                cost = estimate_job_cost(entry, is_audio)
+                cost += FAIR_SHARE_PENALTY * len(items)
+            items[key] = (key, video_url, is_audio, cost, True)
+        if len(items) >= PLAYLIST_MAX_ITEMS:
+            break
+
+    if not items:
+        telegram.edit_message_text(
+            "❌ No videos found in this playlist.", message.chat.id, message.message_id
+        )
+        return
+
+    try:
+        batch_id = job_store.submit_batch(
+            user_id, message, info.get("title") or "Untitled", list(items.values())
         )
-        clear_screen()
-        return filename
+    except queue.Full:
+        telegram.edit_message_text(
+            "❌ Sorry, the waiting queue is full. Please try again later.",
+            message.chat.id,
+            message.message_id,
+        )
+        return
+
+    show_batch_status(batch_id)
+    claim_jobs()
+
+
+def get_cached_parts(video_id, is_audio, max_parts=1):
+    """Return (title, [(file_id, caption)]) of a cached upload, or None"""
+    cached = get_cached_file_ids(video_id, is_audio, max_parts) if video_id else None
+    if not cached:
+        return None
+
+    cached_title, file_ids = cached
+    total_parts = len(file_ids)
+    return cached_title, [
+        (
+            (file_id, f"{cached_title} - Part {i}/{total_parts}")
+            if total_parts > 1
+            else (file_id, cached_title)
+        )
+        for i, file_id in enumerate(file_ids, 1)
+    ]
+
+
+def send_cached_request(message, status_msg, url, is_audio, max_parts=1):
+    """Answer a request from Telegram's storage before it is queued.
+
+    Cached uploads only need their file_ids re-sent, so they don't wait
+    for a pipeline slot behind running downloads. Returns False when
+    nothing is cached or Telegram rejected a file_id, which is forgotten so
+    the request gets downloaded again.
+    """
+    video_id = extract_video_id(url)
+    cached = get_cached_parts(video_id, is_audio, max_parts)
+    if not cached:
+        return False
+
+    cached_title, parts = cached
+    try:
+        for file_id, caption in parts:
+            send_media(message.chat.id, file_id, caption, is_audio)
     except Exception as e:
-        print(f"Error downloading: {e}")
+        print(f"Cached file_ids rejected, downloading again: {e}")
+        forget_file_ids(video_id, is_audio, max_parts)
+        return False
+    telegram.edit_message_text(
+        f"✅ Download completed: {cached_title}",
+        status_msg.chat.id,
+        status_msg.message_id,
+    )
+    return True
+
+
+def send_cached_job(job, video_id):
+    """Answer a job straight from Telegram's storage if it was sent before"""
+    cached = get_cached_parts(video_id, job.is_audio, job.max_parts)
+    if not cached:
+        return False
+
+    cached_title, parts = cached
+    with job.lock:
+        job.sent_parts = parts
+    try:
+        job.deliver()
+        job.close()
+        job.deliver()  # Subscribers that joined while sending
+        job.completed = True
+        job.update_status(f"✅ Download completed: {cached_title}")
+        return True
+    except Exception as e:
+        print(f"Cached file_ids rejected, downloading again: {e}")
+        forget_file_ids(video_id, job.is_audio, job.max_parts)
+        with job.lock:
+            job.sent_parts = []
+            job_store.set_sent_parts(job.job_id, [])
+            for sub in job.subscribers:
+                sub.parts_sent = 0
+        return False
+
+
+def extract_job(job):
+    """Extract stage: resolve metadata, answer from cache or pick a format"""
+    url = get_clean_video_url(job.url)
+    if job.url != url:
+        job.update_status("📋 Playlist detected, downloading single video...")
+    job.url = url
+
+    job.video_id = extract_video_id(url)
+    if send_cached_job(job, job.video_id):
         return None
 
+    # Extract metadata once and reuse it for every stage of the job
+    job.info = get_video_info(url)
 
-def download_worker():
-    """Background worker to process download queue"""
-    while True:
-        task = download_queue.get()
+    # Pick the best quality that avoids splitting, within the part budget
+    job.video_format, estimated_size = (
+        (None, None) if job.is_audio else select_video_format(job.info, job.max_parts)
+    )
 
-        try:
-            user_id, message, url, is_audio, cancel_event = task
-
-            # Check file size before downloading
-            if not check_file_size(url):
-                bot.edit_message_text(
-                    "❌ File size exceeds 1.9GB limit. Please choose a smaller video.",
-                    message.chat.id,
-                    message.message_id,
-                )
-                continue
+    # Check file size before downloading
+    if not check_file_size(job.info, estimated_size):
+        job.update_status(
+            "❌ File size exceeds 1.9GB limit. Please choose a smaller video."
+        )
+        return None
 
-            original_url = url
-            url = get_clean_video_url(url)
-            if original_url != url:
-                bot.edit_message_text(
-                    "📋 Playlist detected, downloading single video...",
-                    message.chat.id,
-                    message.message_id,
-                )
+    job.title = job.info.get("title", "Unknown Title")
 
-            with yt_dlp.YoutubeDL({"quiet": True}) as ydl:
-                info = ydl.extract_info(url, download=False)
-                video_title = info.get("title", "Unknown Title")
+    # Hold the job back until there is scratch space for it
+    scratch_size = estimate_scratch_size(job.info, job.is_audio, estimated_size)
+    if not reserve_workdir(job, scratch_size):
+        if not job.cancel_event.is_set():
+            job.update_status(
+                "❌ Not enough disk space for this video. Please choose a smaller one."
+            )
+        return None
 
-                bot.edit_message_text(
-                    f"⏳ Downloading: {video_title}...",
-                    message.chat.id,
-                    message.message_id,
-                )
+    job.update_status(f"⏳ Waiting for a download slot: {job.title}...")
+    return download_queue
 
-            if cancel_event.is_set():
-                bot.edit_message_text(
-                    "❌ Download cancelled.", message.chat.id, message.message_id
-                )
-                continue
 
-            filename = download_youtube_content(url, is_audio, cancel_event)
+def download_job(job):
+    """Download stage: fetch the file with yt-dlp"""
+    job.update_status(f"⏳ Downloading: {job.title}...")
 
-            if cancel_event.is_set():
-                if filename and os.path.exists(filename):
-                    os.remove(filename)
-                bot.edit_message_text(
-                    "❌ Download cancelled.", message.chat.id, message.message_id
-                )
-            elif filename and os.path.exists(filename):
-                try:
-                    file_size = os.path.getsize(filename)
+    job.progress = {}
+    bandwidth.add(job.job_id)
+    try:
+        job.filename, downloaded = download_youtube_content(
+            job.url,
+            job.is_audio,
+            job.cancel_event,
+            job.info,
+            job.video_format,
+            job.progress,
+            job.workdir,
+            partial(bandwidth.throttle, job.job_id),
+        )
+    finally:
+        job.progress = None
+        bandwidth.remove(job.job_id)
 
-                    if file_size > MAX_TELEGRAM_SIZE:
-                        bot.edit_message_text(
-                            f"📦 File is too large for Telegram. Splitting into parts...\n⏳ Please be patient, it may take time.",
-                            message.chat.id,
-                            message.message_id,
-                        )
+    if job.cancel_event.is_set():
+        return None
 
-                        # Choose appropriate splitting function based on content type
-                        parts = (
-                            split_audio(filename) if is_audio else split_video(filename)
-                        )
-                        total_parts = len(parts)
-
-                        if total_parts == 0:
-                            bot.edit_message_text(
-                                f"❌ Error splitting {'audio' if is_audio else 'video'}. File might be corrupted.",
-                                message.chat.id,
-                                message.message_id,
-                            )
-                            if os.path.exists(filename):
-                                os.remove(filename)
-                            return
-
-                        for i, part in enumerate(parts, 1):
-                            if cancel_event.is_set():
-                                break
-
-                            bot.edit_message_text(
-                                f"📤 Sending part {i}/{total_parts}...",
-                                message.chat.id,
-                                message.message_id,
-                            )
-
-                            with open(part, "rb") as file:
-                                caption = f"{video_title} - Part {i}/{total_parts}"
-                                if is_audio:
-                                    bot.send_audio(
-                                        message.chat.id, file, caption=caption
-                                    )
-                                else:
-                                    bot.send_video(
-                                        message.chat.id, file, caption=caption
-                                    )
-
-                            os.remove(part)
-
-                        os.remove(filename)
-
-                        if not cancel_event.is_set():
-                            bot.edit_message_text(
-                                f"✅ Download completed: {video_title}\nSent in {total_parts} parts",
-                                message.chat.id,
-                                message.message_id,
-                            )
-                    else:
-                        with open(filename, "rb") as file:
-                            if is_audio:
-                                bot.send_audio(
-                                    message.chat.id, file, caption=video_title
-                                )
-                            else:
-                                bot.send_video(
-                                    message.chat.id, file, caption=video_title
-                                )
-
-                        os.remove(filename)
-                        bot.edit_message_text(
-                            f"✅ Download completed: {video_title}",
-                            message.chat.id,
-                            message.message_id,
-                        )
-                except Exception as send_error:
-                    bot.edit_message_text(
-                        f"❌ Error sending file: {send_error}",
-                        message.chat.id,
-                        message.message_id,
+    if not job.filename or not os.path.exists(job.filename):
+        job.update_status(
+            "❌ Download failed. Possible reasons:\n"
+            "• Invalid URL\n"
+            "• Network issues\n"
+            "• Video unavailable"
+        )
+        return None
+
+    # The format yt-dlp really picked, for specs like VIDEO_FORMAT
+    if not job.is_audio:
+        job.width, job.height = get_download_dimensions(downloaded)
+    metrics.inc("download_bytes_total", os.path.getsize(job.filename))
+    return split_queue
+
+
+def prepare_upload(job):
+    """Make a video streamable and thumbnailed, timing both steps for the job"""
+    duration = job.info.get("duration")
+
+    # Merged downloads already are faststart, progressive ones may not be
+    started = time.monotonic()
+    if os.path.getsize(job.filename) <= MAX_TELEGRAM_SIZE and not is_faststart(
+        job.filename
+    ):
+        remux_faststart(job.filename, job.cancel_event)
+        job.add_timing("remux", time.monotonic() - started)
+
+    started = time.monotonic()
+    job.thumbnail = make_thumbnail(job.filename, duration, job.cancel_event)
+    job.add_timing("thumbnail", time.monotonic() - started)
+
+
+def split_job(job):
+    """Split stage: make the file sendable and start producing its parts.
+
+    Oversized files are handed to the upload stage once their first part is
+    ready, the rest keep being produced on the split pool while it uploads.
+    """
+    is_audio = job.is_audio
+
+    # Remuxing and thumbnails run on the transcode pool like splitting
+    if not is_audio:
+        split_executor.submit(prepare_upload, job).result()
+
+    if os.path.getsize(job.filename) <= MAX_TELEGRAM_SIZE:
+        job.update_status(f"📤 Waiting to send: {job.title}...")
+        return upload_queue
+
+    job.update_status(
+        f"📦 File is too large for Telegram. Splitting into parts...\n⏳ Please be patient, it may take time."
+    )
+
+    # Choose appropriate splitting plan based on content type
+    planned = (
+        plan_audio_split(
+            job.filename, job.info.get("duration"), cancel_event=job.cancel_event
+        )
+        if is_audio
+        else plan_video_split(
+            job.filename,
+            cancel_event=job.cancel_event,
+            duration=job.info.get("duration"),
+        )
+    )
+    if not planned:
+        job.update_status(
+            f"❌ Error splitting {'audio' if is_audio else 'video'}. File might be corrupted."
+        )
+        return None
+
+    # Parts sent before the job was interrupted and resumed are skipped
+    job.part_durations = [duration for _, duration in planned]
+    job.parts = SplitParts([part_job for part_job, _ in planned][len(job.sent_parts) :])
+    job.parts.wait()
+    return upload_queue
+
+
+def upload_job(job):
+    """Upload stage: send the file, or its parts as the split stage produces them"""
+    is_audio = job.is_audio
+    video_id = job.video_id
+    video_title = job.title
+
+    # Parts sent before the job was interrupted and resumed are skipped
+    resumed_parts = len(job.sent_parts)
+
+    try:
+        if job.parts is not None:
+            total_parts = len(job.part_durations)
+            started = time.monotonic()
+            for i, part in enumerate(job.parts, resumed_parts + 1):
+                # Time spent waiting on the split pool for the next part
+                job.add_timing("part_wait", time.monotonic() - started)
+                if job.cancel_event.is_set():
+                    break
+
+                if not part:
+                    job.update_status(
+                        f"❌ Error splitting {'audio' if is_audio else 'video'}. File might be corrupted."
                     )
-                    if os.path.exists(filename):
-                        os.remove(filename)
+                    return None
+
+                job.update_status(f"📤 Sending part {i}/{total_parts}...")
+                started = time.monotonic()
+                try:
+                    job.send_part(
+                        part,
+                        f"{video_title} - Part {i}/{total_parts}",
+                        job.part_durations[i - 1],
+                    )
+                finally:
+                    os.remove(part)
+                job.add_timing("send", time.monotonic() - started)
+                started = time.monotonic()
+
+            if not job.cancel_event.is_set():
+                job.close()
+                job.deliver()
+                file_ids = [file_id for file_id, _ in job.sent_parts]
+                if video_id and all(file_ids):
+                    store_file_ids(
+                        video_id, is_audio, video_title, file_ids, job.max_parts
+                    )
+                job.completed = True
+                job.update_status(
+                    f"✅ Download completed: {video_title}\nSent in {total_parts} parts"
+                )
+        else:
+            if resumed_parts:
+                file_id = job.sent_parts[0][0]
             else:
-                bot.edit_message_text(
-                    "❌ Download failed. Possible reasons:\n"
-                    "• Invalid URL\n"
-                    "• Network issues\n"
-                    "• Video unavailable",
-                    message.chat.id,
-                    message.message_id,
+                started = time.monotonic()
+                file_id = job.send_part(
+                    job.filename, video_title, job.info.get("duration")
                 )
+                job.add_timing("send", time.monotonic() - started)
+
+            job.close()
+            job.deliver()
+            if video_id and file_id:
+                store_file_ids(
+                    video_id, is_audio, video_title, [file_id], job.max_parts
+                )
+            job.completed = True
+            job.update_status(f"✅ Download completed: {video_title}")
+    except Exception as send_error:
+        job.update_status(f"❌ Error sending file: {send_error}")
+    return None
+
+
+def finish_job(job):
+    """Release a job that left the pipeline and claim the next waiting jobs"""
+    for step in ("part_wait", "send", "remux", "thumbnail"):
+        if step in job.timings:
+            metrics.observe("step_seconds", job.timings[step], step=step)
+    if job.parts is not None:
+        job.parts.close()  # Parts the upload stage didn't get to
+    job.finish()
+    with download_lock:
+        in_flight_jobs.pop(job.job_id, None)
+
+    # Keep the files if another process took the job over to resume it
+    if job.workdir:
+        state, owner = job_store.get_owner(job.job_id)
+        if state != "running" or owner == WORKER_ID:
+            shutil.rmtree(job.workdir, ignore_errors=True)
+
+    # Start the next jobs from the store
+    claim_jobs()
+
+
+def stage_worker(stage_queue, stage):
+    """Background worker running one pipeline stage for jobs from its queue.
+
+    A stage returns the queue of the next stage, or None when the job is
+    done. Putting into a full stage queue blocks, which holds jobs back in
+    the previous stage until the next one has capacity, or they get cancelled.
+    """
+    name = stage.__name__.split("_")[0]
+    while True:
+        job = stage_queue.get()
+        next_queue = None
+        started = time.monotonic()
+        waited = started - job.queued_at
+
+        try:
+            if not job.cancel_event.is_set():
+                next_queue = stage(job)
         except Exception as e:
-            bot.reply_to(message, f"An unexpected error occurred: {e}")
+            for sub in job.active_subscribers():
+                try:
+                    telegram.send_message(
+                        sub.chat_id,
+                        f"An unexpected error occurred: {e}",
+                        reply_to_message_id=sub.message_id,
+                    )
+                except Exception:
+                    pass
         finally:
-            with download_lock:
-                if user_id in user_downloads:
-                    user_downloads.pop(user_id, None)
+            stage_queue.task_done()
+
+        seconds = time.monotonic() - started
+        metrics.observe("stage_wait_seconds", waited, stage=name)
+        metrics.observe("stage_seconds", seconds, stage=name)
+        job.add_timing(f"{name}_wait", waited)
+        job.add_timing(name, seconds)
+        trace_job(job, name, wait=round(waited, 3), seconds=round(seconds, 3))
+
+        if next_queue is None or not pass_on(job, next_queue):
+            finish_job(job)
 
-            download_queue.task_done()
 
-            # Process next user in waiting queue
-            process_waiting_queue()
+def pass_on(job, next_queue):
+    """Put a job into the next stage's queue once it has room.
+
+    Returns False if the job got cancelled while it waited, so the worker
+    can release it right away instead of holding on until room frees up.
+    """
+    job.queued_at = time.monotonic()
+    while not job.cancel_event.is_set():
+        try:
+            next_queue.put(job, timeout=JOB_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
 
 
 @bot.message_handler(commands=["queue"])
@@ -450,34 +3038,35 @@ def check_queue_position(message):
     """Allow users to check their position in the queue"""
     user_id = message.from_user.id
 
+    # Playlists report on all of their videos at once
+    batch_id = job_store.find_batch(user_id)
+    if batch_id:
+        _, _, title, counts = job_store.get_batch(batch_id)
+        telegram.reply_to(message, format_batch_status(title, counts))
+        return
+
     # Check if user is in active downloads
-    if user_id in user_downloads:
-        bot.reply_to(message, "Your download is currently in progress! ⏳")
+    found = job_store.find_user(user_id)
+    if found and found[1] == "running":
+        job = find_user_job(user_id)
+        if job and job.progress:
+            telegram.reply_to(
+                message,
+                "Your download is currently in progress! ⏳\n\n"
+                + format_progress(job.title, job.progress),
+            )
+        else:
+            telegram.reply_to(message, "Your download is currently in progress! ⏳")
         return
 
     # Check waiting queue
-    position = 1
-    found = False
-    temp_queue = Queue()
-
-    while not waiting_queue.empty():
-        task = waiting_queue.get()
-        if task[0] == user_id:
-            found = True
-        temp_queue.put(task)
-        if not found:
-            position += 1
-
-    # Restore queue
-    while not temp_queue.empty():
-        waiting_queue.put(temp_queue.get())
-
-    if found:
-        bot.reply_to(
+    position = job_store.position(user_id)
+    if position:
+        telegram.reply_to(
             message, f"You are position #{position} in the queue. Please wait... ⌛"
         )
     else:
-        bot.reply_to(message, "You are not currently in the queue.")
+        telegram.reply_to(message, "You are not currently in the queue.")
 
 
 @bot.message_handler(commands=["cancel"])
@@ -485,14 +3074,38 @@ def cancel_download(message):
     """Handle download cancellation requests"""
     user_id = message.from_user.id
 
-    with download_lock:
-        if user_id not in user_downloads:
-            bot.reply_to(message, "❌ You don't have any active downloads to cancel.")
-            return
+    cancelled = job_store.cancel(user_id)
+    if not cancelled:
+        telegram.reply_to(message, "❌ You don't have any active downloads to cancel.")
+        return
 
-        message_id, cancel_event = user_downloads[user_id]
-        cancel_event.set()
-        bot.reply_to(message, "🛑 Cancelling your download...")
+    batches = set()
+    for job_id, state, chat_id, message_id, batch_id in cancelled:
+        # A playlist is cancelled as a whole, with one reply
+        if batch_id is not None:
+            batches.add(batch_id)
+
+        # Users still waiting for their turn are simply taken out of the queue
+        if state == "waiting":
+            if batch_id is None:
+                telegram.edit_message_text(
+                    "❌ Download cancelled.", chat_id, message_id
+                )
+                telegram.reply_to(message, "🛑 You have been removed from the queue.")
+            continue
+
+        # Shared jobs only stop once every subscriber has cancelled. Jobs run
+        # by another process notice on their next heartbeat
+        with download_lock:
+            job = in_flight_jobs.get(job_id)
+        if job:
+            job.sync()
+        if batch_id is None:
+            telegram.reply_to(message, "🛑 Cancelling your download...")
+
+    for batch_id in batches:
+        show_batch_status(batch_id)
+        telegram.reply_to(message, "🛑 Your playlist has been cancelled.")
 
 
 @bot.message_handler(commands=["help", "start"])
@@ -504,10 +3117,14 @@ Hi there! I'm iiMeow Video Downloader 🐈
 I can help you download YouTube videos and audio:
 • /audio [YouTube URL] - Download audio
 • /video [YouTube URL] - Download video
+• /video [YouTube URL] [parts] - Download better quality split into up to [parts]
+• /playlist [YouTube URL] - Download every video of a playlist
+• /playlist [YouTube URL] audio - Download a playlist as audio
 • /cancel - Cancel your current download
 • /queue - Check your position in queue
 
 Note: 
+- Videos are downloaded in the best quality that fits in one message
 - Large videos will be split into parts due to Telegram's size limit
 - Maximum file size: 1.9GB
 - If the system is busy, you'll be placed in a queue
@@ -519,7 +3136,7 @@ Examples:
 Follow our channels on Telegram:
 » @darks1ders
 """
-    bot.reply_to(message, welcome_text)
+    telegram.reply_to(message, welcome_text)
 
 
 @bot.message_handler(func=lambda message: message.text.startswith(("/audio", "/video")))
@@ -530,61 +3147,169 @@ def handle_download(message):
         is_audio = command == "/audio"
         user_id = message.from_user.id
 
-        # Check for ongoing downloads
-        with download_lock:
-            if user_id in user_downloads:
-                bot.reply_to(
-                    message,
-                    "❌ You already have a download in progress. Use /cancel to stop it.",
-                )
-                return
+        # Videos may be given a part budget to trade splitting for quality
+        url, *options = url.split()
+        max_parts = 1
+        if options and options[0].isdigit() and not is_audio:
+            max_parts = max(1, min(int(options[0]), MAX_PART_BUDGET))
+
+        if not admit_request(message, user_id):
+            return
 
-        # Create cancellation event and processing message
-        cancel_event = threading.Event()
-        processing_msg = bot.reply_to(message, "Processing your request... 🔄")
+        processing_msg = telegram.reply_to(message, "Processing your request... 🔄")
 
-        # Check if there's room for immediate processing
-        with download_lock:
-            if len(user_downloads) < MAX_CONCURRENT_DOWNLOADS:
-                user_downloads[user_id] = (processing_msg.message_id, cancel_event)
-                download_queue.put(
-                    (user_id, processing_msg, url, is_audio, cancel_event)
+        # Videos sent before go out right away, without being queued
+        if send_cached_request(message, processing_msg, url, is_audio, max_parts):
+            return
+
+        # Queue the job ordered by its expected cost, or share an identical
+        # download that is already queued or running
+        try:
+            job_id, status = submit_download(
+                user_id,
+                processing_msg,
+                url,
+                is_audio,
+                max_parts,
+                get_job_cost(user_id, url, is_audio, max_parts),
+            )
+        except queue.Full:
+            telegram.edit_message_text(
+                "❌ Sorry, the waiting queue is full. Please try again later.",
+                processing_msg.chat.id,
+                processing_msg.message_id,
+            )
+            return
+
+        # Start right away if this process has a free slot
+        claim_jobs()
+        queue_position = job_store.position(user_id)
+        if queue_position:
+            text = (
+                f"Queue is full. You are position #{queue_position} in line.\n"
+                f"Use /queue to check your position.\n"
+                f"Your download will start automatically when it's your turn."
+            )
+            if job_store.set_status(job_id, text, "waiting"):
+                telegram.edit_message_text(
+                    text, processing_msg.chat.id, processing_msg.message_id
                 )
-            else:
-                # Try to add to waiting queue
-                try:
-                    waiting_queue.put_nowait(
-                        (user_id, processing_msg, url, is_audio, cancel_event)
-                    )
-                    queue_position = waiting_queue.qsize()
-                    bot.edit_message_text(
-                        f"Queue is full. You are position #{queue_position} in line.\n"
-                        f"Use /queue to check your position.\n"
-                        f"Your download will start automatically when it's your turn.",
-                        processing_msg.chat.id,
-                        processing_msg.message_id,
-                    )
-                except Queue.Full:
-                    bot.edit_message_text(
-                        "❌ Sorry, the waiting queue is full. Please try again later.",
-                        processing_msg.chat.id,
-                        processing_msg.message_id,
-                    )
+            if SCHEDULER_POLICY != "fifo" and not peek_video_info(url):
+                prefetch_executor.submit(
+                    prefetch_job_cost, job_id, user_id, url, is_audio, max_parts
+                )
+        elif status:
+            telegram.edit_message_text(
+                status, processing_msg.chat.id, processing_msg.message_id
+            )
 
     except ValueError:
-        bot.reply_to(
+        telegram.reply_to(
             message, "❌ Please provide a valid YouTube URL after the command."
         )
     except Exception as e:
-        bot.reply_to(message, f"An unexpected error occurred: {e}")
+        telegram.reply_to(message, f"An unexpected error occurred: {e}")
+
+
+@bot.message_handler(commands=["playlist"])
+def handle_playlist(message):
+    """Handle requests for every video of a playlist"""
+    try:
+        command, url = message.text.split(maxsplit=1)
+        url, *options = url.split()
+        is_audio = options[:1] == ["audio"]
+        user_id = message.from_user.id
+
+        if not admit_request(message, user_id):
+            return
+
+        processing_msg = telegram.reply_to(message, "📋 Reading the playlist... 🔄")
+
+        # Listing a long playlist takes a while, don't hold up the chat
+        prefetch_executor.submit(
+            submit_playlist, user_id, processing_msg, url, is_audio
+        )
+
+    except ValueError:
+        telegram.reply_to(
+            message, "❌ Please provide a valid playlist URL after the command."
+        )
+    except Exception as e:
+        telegram.reply_to(message, f"An unexpected error occurred: {e}")
 
 
-# Start download workers
-for _ in range(MAX_CONCURRENT_DOWNLOADS):
-    worker_thread = threading.Thread(target=download_worker, daemon=True)
-    worker_thread.start()
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Receives updates posted by Telegram and hands them to the dispatcher"""
+
+    def do_POST(self):
+        if self.path != (urlparse(WEBHOOK_URL).path or "/"):
+            self.send_error(404)
+            return
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token")
+        if WEBHOOK_SECRET and secret != WEBHOOK_SECRET:
+            self.send_error(403)
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            update = telebot.types.Update.de_json(self.rfile.read(length).decode())
+        except ValueError:
+            self.send_error(400)
+            return
+        bot.process_new_updates([update])
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    """Webhook server with a backlog for every connection Telegram may open"""
+
+    daemon_threads = True
+    request_queue_size = 100  # Highest max_connections of a webhook
+
+
+def run_webhook():
+    """Register the webhook with Telegram and serve updates until stopped"""
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    server = WebhookServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookHandler)
+    print(f"Serving webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}")
+    server.serve_forever()
+
+
+def start_pipeline():
+    """Start the stage workers and background threads that run jobs"""
+    # Clean up after jobs that ended while no process was running them
+    sweep_scratch()
+
+    for stage_queue, stage, workers in (
+        (extract_queue, extract_job, EXTRACT_WORKERS),
+        (download_queue, download_job, MAX_CONCURRENT_DOWNLOADS),
+        (split_queue, split_job, SPLIT_WORKERS),
+        (upload_queue, upload_job, UPLOAD_WORKERS),
+    ):
+        for _ in range(workers):
+            worker_thread = threading.Thread(
+                target=stage_worker, args=(stage_queue, stage), daemon=True
+            )
+            worker_thread.start()
+
+    threading.Thread(target=progress_reporter, daemon=True).start()
+    threading.Thread(target=job_keeper, daemon=True).start()
+
 
 # Start the bot
 if __name__ == "__main__":
     clear_screen()
-    bot.infinity_polling()
\ No newline at end of file
+    start_pipeline()
+    start_metrics_server()
+    if "--worker" in sys.argv:
+        # Extra worker processes only run jobs, a single process polls Telegram
+        threading.Event().wait()
+    elif WEBHOOK_URL:
+        run_webhook()
+    else:
+        bot.infinity_polling()
@@ -0,0 +1,59 @@
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+import telebot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# bot.py reads its settings and opens its stores on import, so point them
+# at a scratch directory before any test imports it
+STORE_DIR = tempfile.mkdtemp(prefix="iimeow-tests-")
+os.environ.update(
+    {
+        "IIMEOW_API_TOKEN": "123456:test",
+        "IIMEOW_METRICS_PORT": "null",
+        "IIMEOW_JOB_STORE_PATH": os.path.join(STORE_DIR, "jobs.db"),
+        "IIMEOW_FILE_ID_CACHE_PATH": os.path.join(STORE_DIR, "file_ids.db"),
+        "IIMEOW_JOB_TRACE_PATH": os.path.join(STORE_DIR, "job_trace.jsonl"),
+        "IIMEOW_SCRATCH_DIR": os.path.join(STORE_DIR, "downloads"),
+    }
+)
+sys.path.insert(0, ROOT)
+
+from benchmark import BotApiHandler, FakeTelegram, start_server  # noqa: E402
+
+
+@pytest.fixture
+def bot():
+    import bot
+
+    return bot
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    """FakeTelegram served locally at its url, with telebot pointed at it"""
+    fake = FakeTelegram()
+    server = start_server(BotApiHandler, telegram=fake)
+    fake.url = f"http://127.0.0.1:{server.server_port}"
+    monkeypatch.setattr(telebot.apihelper, "API_URL", fake.url + "/bot{0}/{1}")
+    yield fake
+    server.shutdown()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def load_info_dict(name):
+    """Load a trimmed info_dict from tests/fixtures/info_dicts"""
+    with open(os.path.join(FIXTURES, "info_dicts", f"{name}.json")) as file:
+        return json.load(file)
@@ -0,0 +1,57 @@
+import shutil
+
+import pytest
+
+from benchmark import CLIPS, MediaHandler, make_clip, start_server
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="test clips are made with ffmpeg"
+)
+
+
+@pytest.fixture
+def clip_url():
+    server = start_server(MediaHandler)
+    yield f"http://127.0.0.1:{server.server_port}/{make_clip('small', CLIPS['small'])}"
+    server.shutdown()
+
+
+def test_dimensions_come_from_the_downloaded_format(bot, clip_url, tmp_path):
+    # The top level describes yt-dlp's default pick, not what VIDEO_FORMAT gets
+    info = {
+        "id": "clip",
+        "title": "clip",
+        "extractor": "generic",
+        "extractor_key": "Generic",
+        "webpage_url": clip_url,
+        "duration": 10,
+        "width": 1920,
+        "height": 1080,
+        "formats": [
+            {
+                "format_id": "18",
+                "url": clip_url,
+                "ext": "mp4",
+                "vcodec": "avc1",
+                "acodec": "mp4a",
+                "width": 640,
+                "height": 360,
+            },
+            {
+                "format_id": "248",
+                "url": clip_url,
+                "ext": "webm",
+                "vcodec": "vp9",
+                "acodec": "opus",
+                "width": 1920,
+                "height": 1080,
+            },
+        ],
+    }
+
+    filename, downloaded = bot.download_youtube_content(
+        clip_url, False, None, info, bot.VIDEO_FORMAT, None, str(tmp_path)
+    )
+
+    assert filename.startswith(str(tmp_path))
+    assert bot.get_download_dimensions(downloaded) == (640, 360)
@@ -0,0 +1,53 @@
+import pytest
+
+from conftest import load_info_dict
+
+MIB = 1024 * 1024
+
+# (info_dict fixture, Telegram limit, part budget, expected format, expected size)
+CASES = [
+    # The best merged pair under one message's limit
+    ("music_video", 50 * MIB, 1, "136+140", 33430000),
+    # A larger budget buys the 1080p pair, split afterwards
+    ("music_video", 50 * MIB, 2, "137+140", 63430000),
+    # Nothing fits one 8 MiB message, so the download gets split
+    ("music_video", 8 * MIB, 1, None, None),
+    # Three 8 MiB parts hold the progressive 360p, not the 1080p pair
+    ("music_video", 8 * MIB, 3, "18", 9000000),
+    # Sizes estimated from tbr and duration
+    ("long_lecture", 50 * MIB, 1, None, None),
+    ("long_lecture", 50 * MIB, 5, "18", 225000000),
+    ("long_lecture", 50 * MIB, 10, "135+140", 373050000),
+    # Without a duration only formats with a known size can be picked
+    ("unknown_duration", 50 * MIB, 1, "22", 40000000),
+    # WebM can't be sent as a streamable MP4
+    ("webm_only", 50 * MIB, 1, None, None),
+]
+
+
+@pytest.mark.parametrize("fixture, limit, max_parts, expected, size", CASES)
+def test_select_video_format(
+    bot, monkeypatch, fixture, limit, max_parts, expected, size
+):
+    monkeypatch.setattr(bot, "MAX_TELEGRAM_SIZE", limit)
+    info = load_info_dict(fixture)
+
+    video_format, estimated_size = bot.select_video_format(info, max_parts)
+
+    assert video_format == (expected or bot.VIDEO_FORMAT)
+    if size is None:
+        assert estimated_size is None
+    else:
+        assert estimated_size == pytest.approx(size)
+
+
+@pytest.mark.parametrize("max_parts", range(1, 11))
+def test_selected_format_fits_part_budget(bot, monkeypatch, max_parts):
+    monkeypatch.setattr(bot, "MAX_TELEGRAM_SIZE", 8 * MIB)
+    info = load_info_dict("long_lecture")
+    info["duration"] = 300
+
+    _, estimated_size = bot.select_video_format(info, max_parts)
+
+    part_size = bot.MAX_TELEGRAM_SIZE - bot.SPLIT_HEADROOM
+    assert estimated_size is None or estimated_size <= max_parts * part_size
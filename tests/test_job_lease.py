@@ -0,0 +1,108 @@
+import queue
+import subprocess
+import sys
+import time
+import types
+
+import pytest
+
+from benchmark import bot_environment
+from conftest import ROOT, wait_until
+
+# Claims a job and then hangs in the middle of it, until it is killed
+WORKER = """
+import time
+import bot
+assert bot.claim_jobs()
+print(*bot.in_flight_jobs, flush=True)
+time.sleep(60)
+"""
+
+
+@pytest.fixture
+def store(bot, tmp_path, monkeypatch):
+    """A fresh job store for this process, with nothing in flight"""
+    path = str(tmp_path / "jobs.db")
+    monkeypatch.setattr(bot, "JOB_STORE_PATH", path)
+    monkeypatch.setattr(bot, "job_store", bot.JobStore(path))
+    monkeypatch.setattr(bot, "extract_queue", queue.Queue())
+    monkeypatch.setattr(bot, "in_flight_jobs", {})
+    return bot.job_store
+
+
+def submit(store, user_id=1):
+    message = types.SimpleNamespace(
+        chat=types.SimpleNamespace(id=user_id), message_id=100
+    )
+    key = ("dQw4w9WgXcQ", "video", 1)
+    job_id, _ = store.submit(key, "https://youtu.be/dQw4w9WgXcQ", False, 1, 1, message)
+    return job_id
+
+
+def edits(telegram, chat_id=1):
+    return [
+        call[3]
+        for call in telegram.chats.get(chat_id, [])
+        if call[1] == "editMessageText"
+    ]
+
+
+def test_job_of_killed_worker_is_leased_again(bot, telegram, store):
+    job_id = submit(store)
+    env = bot_environment(
+        {
+            "JOB_STORE_PATH": bot.JOB_STORE_PATH,
+            "JOB_LEASE_TIME": 1,
+            "TELEGRAM_API_URL": telegram.url,
+        }
+    )
+    worker = subprocess.Popen(
+        [sys.executable, "-c", WORKER],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert worker.stdout.readline().split() == [str(job_id)]
+    finally:
+        worker.kill()
+        worker.wait()
+
+    # Held by the dead worker until its lease runs out
+    assert not bot.claim_jobs()
+    time.sleep(1.1)
+    assert bot.claim_jobs()
+
+    job = bot.extract_queue.get_nowait()
+    assert job.job_id == job_id
+    assert [sub.user_id for sub in job.subscribers] == [1]
+    assert store.heartbeat(bot.WORKER_ID, [job_id]) == {job_id}
+    wait_until(
+        lambda: "🔄 Resuming your download after a restart..." in edits(telegram)
+    )
+
+
+def test_job_fails_after_max_retries(bot, telegram, store, monkeypatch):
+    monkeypatch.setattr(bot, "JOB_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(bot, "JOB_LEASE_TIME", 0)
+    job_id = submit(store)
+
+    # The first run and two retries, each abandoned right away
+    for _ in range(1 + bot.JOB_MAX_ATTEMPTS):
+        assert bot.claim_jobs()
+        assert bot.extract_queue.get_nowait().job_id == job_id
+        bot.in_flight_jobs.clear()
+        time.sleep(0.01)
+
+    assert bot.claim_jobs()
+    assert bot.extract_queue.empty()
+    assert job_id not in bot.in_flight_jobs
+    state = store.db.execute("SELECT state FROM jobs WHERE id = ?", (job_id,))
+    assert state.fetchone()[0] == "failed"
+
+    # Also waits for the status edits, so none reach a later test's stub
+    wait_until(
+        lambda: edits(telegram)[-1:]
+        == ["❌ Download failed after repeated interruptions. Please try again."]
+    )
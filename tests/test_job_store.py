@@ -0,0 +1,116 @@
+import queue
+import random
+import sqlite3
+import threading
+import time
+import types
+
+USERS = 24
+REQUESTS_PER_USER = 15
+VIDEOS = 10  # Few enough that users often share a job
+QUEUE_SIZE = 20
+
+
+def message(user_id):
+    return types.SimpleNamespace(
+        chat=types.SimpleNamespace(id=user_id), message_id=user_id
+    )
+
+
+def test_concurrent_submit_claim_cancel_position(bot, tmp_path, monkeypatch):
+    """Hammer the store from several connections, like processes sharing it.
+
+    Users submit, cancel and check their position while workers claim and
+    finish jobs. Afterwards no job may have been claimed twice, been left
+    behind, or been cancelled while someone still waited on it.
+    """
+    monkeypatch.setattr(bot, "MAX_QUEUE_SIZE", QUEUE_SIZE)
+    path = str(tmp_path / "jobs.db")
+    stores = [bot.JobStore(path) for _ in range(3)]
+
+    lock = threading.Lock()
+    submitted = []  # (job_id, user_id) of accepted requests
+    claims = []  # job_id of every claim
+    positions = []
+    errors = []
+    users_done = threading.Event()
+
+    def user(user_id):
+        rng = random.Random(user_id)
+        store = stores[user_id % len(stores)]
+        try:
+            for _ in range(REQUESTS_PER_USER):
+                key = (f"video{rng.randrange(VIDEOS)}", "video", 1)
+                try:
+                    job_id, _ = store.submit(
+                        key, key[0], False, 1, user_id, message(user_id), rng.random()
+                    )
+                except queue.Full:
+                    continue
+                with lock:
+                    submitted.append((job_id, user_id))
+                position = store.position(user_id)
+                with lock:
+                    positions.append(position)
+                if rng.random() < 0.3:
+                    store.cancel(user_id)
+                time.sleep(rng.random() * 0.005)
+        except Exception as e:
+            errors.append(e)
+
+    def worker(number):
+        store = stores[number % len(stores)]
+        owner = f"worker{number}"
+        try:
+            while True:
+                claimed = store.claim(owner, 2)
+                with lock:
+                    claims.extend(job[0] for job in claimed)
+                for job in claimed:
+                    store.finish(job[0], owner, "done")
+                if not claimed:
+                    if users_done.is_set() and not store.count_waiting():
+                        return
+                    time.sleep(0.002)
+        except Exception as e:
+            errors.append(e)
+
+    users = [threading.Thread(target=user, args=(i,)) for i in range(USERS)]
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(6)]
+    for thread in users + workers:
+        thread.start()
+    for thread in users:
+        thread.join()
+    users_done.set()
+    for thread in workers:
+        thread.join()
+
+    assert errors == []
+    assert submitted
+
+    db = sqlite3.connect(path)
+    states = dict(db.execute("SELECT id, state FROM jobs"))
+    subscribers = set(db.execute("SELECT job_id, user_id FROM subscribers"))
+
+    # No job was run twice, and every job ended
+    assert len(claims) == len(set(claims))
+    assert set(states.values()) <= {"done", "cancelled"}
+    assert all(states[job_id] in ("done", "cancelled") for job_id in claims)
+
+    # Jobs nobody claimed were cancelled, never lost
+    for job_id, state in states.items():
+        if job_id not in claims:
+            assert state == "cancelled"
+
+    # Every accepted request is recorded
+    assert set(submitted) <= subscribers
+
+    # A job is only cancelled once every subscriber cancelled it
+    waiting_on_cancelled = db.execute(
+        "SELECT COUNT(*) FROM subscribers JOIN jobs ON jobs.id = job_id "
+        "WHERE state = 'cancelled' AND NOT cancelled"
+    ).fetchone()[0]
+    assert waiting_on_cancelled == 0
+
+    # The waiting queue never grew past its limit
+    assert all(p is None or 1 <= p <= QUEUE_SIZE for p in positions)
@@ -0,0 +1,71 @@
+import threading
+import time
+import types
+
+import pytest
+
+from conftest import wait_until
+
+URL = "https://youtu.be/dQw4w9WgXcQ"
+
+
+@pytest.fixture
+def extractor(bot, monkeypatch):
+    """Stands in for yt-dlp, holding each extraction until released"""
+    fake = types.SimpleNamespace(calls=[], release=threading.Event(), error=None)
+
+    def extract_info(url):
+        fake.calls.append(url)
+        fake.release.wait(5)
+        if fake.error:
+            raise fake.error
+        return {"id": "dQw4w9WgXcQ", "title": "clip"}
+
+    monkeypatch.setattr(bot, "metadata_cache", bot.OrderedDict())
+    monkeypatch.setattr(bot.ydl_pool, "extract_info", extract_info)
+    return fake
+
+
+def lookup_concurrently(bot, extractor, count):
+    """Look the same video up on count threads at once, returns the results"""
+    results = [None] * count
+
+    def lookup(i):
+        try:
+            results[i] = bot.get_video_info(URL)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=lookup, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: extractor.calls)
+    time.sleep(0.2)  # Lets the others reach the running extraction
+    extractor.release.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_lookups_share_one_extraction(bot, extractor):
+    results = lookup_concurrently(bot, extractor, 4)
+
+    assert len(extractor.calls) == 1
+    assert all(result["title"] == "clip" for result in results)
+    # Every caller gets its own copy to mutate
+    assert len({id(result) for result in results}) == 4
+    assert not bot.metadata_extractions
+
+
+def test_failed_extraction_fails_every_waiting_lookup(bot, extractor):
+    extractor.error = bot.yt_dlp.utils.DownloadError("Video unavailable")
+    results = lookup_concurrently(bot, extractor, 3)
+
+    assert len(extractor.calls) == 1
+    assert all(isinstance(result, bot.yt_dlp.utils.DownloadError) for result in results)
+    assert not bot.metadata_extractions
+
+    # Nothing was cached, the next lookup tries again
+    extractor.error = None
+    assert bot.get_video_info(URL)["title"] == "clip"
+    assert len(extractor.calls) == 2
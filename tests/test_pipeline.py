@@ -0,0 +1,31 @@
+import queue
+import threading
+import time
+import types
+
+
+def make_job():
+    return types.SimpleNamespace(cancel_event=threading.Event(), queued_at=None)
+
+
+def test_pass_on_waits_for_room(bot):
+    next_queue = queue.Queue(maxsize=1)
+    next_queue.put(make_job())
+    job = make_job()
+    threading.Timer(0.2, next_queue.get).start()
+
+    assert bot.pass_on(job, next_queue)
+    assert next_queue.get_nowait() is job
+
+
+def test_cancelled_job_stops_waiting_for_room(bot, monkeypatch):
+    monkeypatch.setattr(bot, "JOB_POLL_INTERVAL", 0.1)
+    next_queue = queue.Queue(maxsize=1)
+    next_queue.put(make_job())
+    job = make_job()
+    threading.Timer(0.2, job.cancel_event.set).start()
+
+    started = time.monotonic()
+    assert not bot.pass_on(job, next_queue)
+    assert time.monotonic() - started < 1
+    assert next_queue.qsize() == 1
@@ -0,0 +1,162 @@
+import threading
+import time
+
+import pytest
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+from conftest import wait_until
+
+
+@pytest.fixture
+def limits(bot, tmp_path):
+    return bot.RateLimitStore(str(tmp_path / "jobs.db"))
+
+
+@pytest.fixture
+def client(bot, telegram, limits):
+    return bot.TelegramClient(telebot.TeleBot("123456:test", threaded=False), limits)
+
+
+def calls(telegram, chat_id, method):
+    return [call for call in telegram.chats.get(chat_id, []) if call[1] == method]
+
+
+def test_call_waits_out_retry_after(bot, telegram, client):
+    telegram.rate_limit(2, retry_after=1, chat_id=1)
+    rate_limits = bot.metrics.values.get(("telegram_rate_limits_total", ()), 0)
+
+    started = time.monotonic()
+    message = client.send_message(1, "hello")
+
+    assert message.text == "hello"
+    assert time.monotonic() - started >= 2
+    assert telegram.rejected == 2
+    assert [call[3] for call in calls(telegram, 1, "sendMessage")] == ["hello"]
+    assert bot.metrics.values[("telegram_rate_limits_total", ())] == rate_limits + 2
+
+
+def test_rate_limit_only_holds_up_its_chat(telegram, client):
+    telegram.rate_limit(1, retry_after=2, chat_id=1)
+    blocked = []
+    thread = threading.Thread(
+        target=lambda: blocked.append(client.send_message(1, "slow"))
+    )
+    thread.start()
+    wait_until(lambda: telegram.rejected == 1)
+
+    started = time.monotonic()
+    client.send_message(2, "fast")
+    assert time.monotonic() - started < 1
+
+    thread.join()
+    assert blocked[0].text == "slow"
+
+
+def test_call_gives_up_after_max_retries(bot, telegram, client, monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_MAX_RETRIES", 1)
+    telegram.rate_limit(5, retry_after=1, chat_id=1)
+
+    with pytest.raises(ApiTelegramException) as error:
+        client.send_message(1, "hello")
+
+    assert error.value.error_code == 429
+    assert telegram.rejected == 2
+    assert calls(telegram, 1, "sendMessage") == []
+
+
+def test_pending_edits_coalesce_to_the_latest_text(telegram, client):
+    telegram.rate_limit(1, retry_after=1, chat_id=1)
+    client.edit_message_text("1", 1, 10)
+    wait_until(lambda: telegram.rejected == 1)
+
+    # Queued while the chat waits out its retry_after
+    for text in ("2", "3", "4", "5"):
+        client.edit_message_text(text, 1, 10)
+    wait_until(lambda: calls(telegram, 1, "editMessageText"))
+
+    # Showing the same text again is not sent
+    client.edit_message_text("5", 1, 10)
+    time.sleep(0.5)
+    assert [call[3] for call in calls(telegram, 1, "editMessageText")] == ["5"]
+
+
+def test_edits_of_different_messages_are_all_sent(telegram, client):
+    for message_id in (10, 11, 12):
+        client.edit_message_text(f"status {message_id}", 1, message_id)
+    wait_until(lambda: len(calls(telegram, 1, "editMessageText")) == 3)
+
+    assert sorted(call[2] for call in calls(telegram, 1, "editMessageText")) == [
+        10,
+        11,
+        12,
+    ]
+
+
+def test_failed_edit_is_retried(telegram, client):
+    telegram.fail(2, 502, chat_id=1)
+    client.edit_message_text("✅ Done", 1, 10)
+
+    wait_until(lambda: calls(telegram, 1, "editMessageText"), timeout=10)
+    assert telegram.failed == 2
+    assert [call[3] for call in calls(telegram, 1, "editMessageText")] == ["✅ Done"]
+
+
+def test_failed_edit_gives_up_after_max_retries(bot, telegram, client, monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_MAX_RETRIES", 1)
+    telegram.fail(5, 500, chat_id=1)
+    client.edit_message_text("✅ Done", 1, 10)
+
+    wait_until(lambda: telegram.failed == 2)
+    time.sleep(3)  # Longer than the backoff of another retry
+    assert telegram.failed == 2
+    assert calls(telegram, 1, "editMessageText") == []
+
+
+def test_slow_edit_doesnt_hold_up_other_chats(telegram, client):
+    telegram.slow_down(1, 2)
+    client.edit_message_text("slow", 1, 10)
+    wait_until(lambda: client.editing)
+
+    started = time.monotonic()
+    client.edit_message_text("fast", 2, 20)
+    wait_until(lambda: calls(telegram, 2, "editMessageText"))
+    assert time.monotonic() - started < 1
+
+
+def test_processes_share_the_global_rate(bot, telegram, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "TELEGRAM_GLOBAL_RATE", 5)
+    # Clients of two processes, each with its own connection to the store
+    clients = [
+        bot.TelegramClient(
+            telebot.TeleBot("123456:test", threaded=False),
+            bot.RateLimitStore(str(tmp_path / "jobs.db")),
+        )
+        for _ in range(2)
+    ]
+
+    def send(client, chat_id):
+        for _ in range(3):
+            client.send_message(chat_id, "hello")
+
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=send, args=(client, chat_id))
+        for chat_id, client in enumerate(clients * 2, 1)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 5 calls go out at once, the other 7 at 5 per second between both
+    assert time.monotonic() - started >= 1.2
+    assert telegram.calls == 12
+
+
+def test_retry_after_holds_up_every_process(bot, limits, tmp_path):
+    other = bot.RateLimitStore(str(tmp_path / "jobs.db"))
+    limits.block(1, 2)
+
+    assert other.take(1) > 1
+    assert other.take(2) <= 0